@@ -1,430 +1,3380 @@
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-"""
-3proxy Configuration Management Service
-Сервис для управления конфигурацией 3proxy
-"""
-
-import os
-import json
-import subprocess
-import ipaddress
-import asyncio
-import aiofiles
-from datetime import datetime
-from aiohttp import web, ClientSession, ClientTimeout, WSMsgType
-from aiohttp_session import setup, get_session, new_session, SimpleCookieStorage
-from aiohttp_cors import setup as cors_setup, ResourceOptions
-from aiohttp_jinja2 import setup as jinja_setup, render_template
-import jinja2
-import bcrypt
-import aiohttp
-
-# Конфигурация
-CONFIG_FILE = 'config/3proxy_ip.cfg'
-ALLOWED_IPS_FILE = 'config/allowed_ips.txt'
-
-class ProxyManager:
-    def __init__(self):
-        self.config_file = CONFIG_FILE
-        self.allowed_ips_file = ALLOWED_IPS_FILE
-        self.ensure_files_exist()
-    
-    def ensure_files_exist(self):
-        """Создает необходимые файлы если их нет"""
-        if not os.path.exists(self.config_file):
-            self.create_default_config()
-        
-        if not os.path.exists(self.allowed_ips_file):
-            with open(self.allowed_ips_file, 'w') as f:
-                f.write("# Разрешенные IP адреса\n")
-    
-    def create_default_config(self):
-        """Создает базовую конфигурацию 3proxy"""
-        default_config = """# 3proxy configuration
-"""
-        with open(self.config_file, 'w') as f:
-            f.write(default_config)
-    
-    async def get_current_ip(self):
-        """Получает текущий внешний IP адрес"""
-        timeout = ClientTimeout(total=5)
-        try:
-            async with ClientSession(timeout=timeout) as session:
-                async with session.get('https://api.ipify.org') as response:
-                    if response.status == 200:
-                        return (await response.text()).strip()
-        except:
-            try:
-                async with ClientSession(timeout=timeout) as session:
-                    async with session.get('https://ipinfo.io/ip') as response:
-                        if response.status == 200:
-                            return (await response.text()).strip()
-            except:
-                pass
-        return "Не удалось определить IP"
-    
-    async def add_allowed_ip(self, ip):
-        """Добавляет IP в список разрешенных"""
-        try:
-            # Валидация IP
-            ipaddress.ip_address(ip)
-            
-            # Читаем текущий список
-            allowed_ips = await self.get_allowed_ips()
-            
-            if ip not in allowed_ips:
-                allowed_ips.append(ip)
-                
-                # Записываем обновленный список
-                content = "# Разрешенные IP адреса\n" + "\n".join(allowed_ips) + "\n"
-                async with aiofiles.open(self.allowed_ips_file, 'w') as f:
-                    await f.write(content)
-                
-                # Обновляем конфиг 3proxy
-                await self.update_proxy_config(allowed_ips)
-                return True
-            return False
-        except ValueError:
-            return False
-    
-    async def get_allowed_ips(self):
-        """Получает список разрешенных IP"""
-        allowed_ips = []
-        if os.path.exists(self.allowed_ips_file):
-            async with aiofiles.open(self.allowed_ips_file, 'r') as f:
-                content = await f.read()
-                for line in content.splitlines():
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        allowed_ips.append(line)
-        return allowed_ips
-    
-    async def update_proxy_config(self, allowed_ips):
-        """Обновляет конфигурацию 3proxy с новыми разрешенными IP"""
-        config_lines = []
-        
-        # Читаем существующий конфиг
-        if os.path.exists(self.config_file):
-            async with aiofiles.open(self.config_file, 'r') as f:
-                content = await f.read()
-                config_lines = content.splitlines()
-        
-        # Удаляем старые allow правила
-        config_lines = [line for line in config_lines if not line.strip().startswith('allow')]
-        
-        # Добавляем новые allow правила
-        for ip in allowed_ips:
-            config_lines.append(f"allow * {ip}\n")
-            
-        # Записываем обновленный конфиг
-        content = "\n".join(config_lines) + "\n"
-        async with aiofiles.open(self.config_file, 'w') as f:
-            await f.write(content)
-    
-    async def restart_proxy(self):
-        """Перезапускает 3proxy (требует sudo)"""
-        try:
-            # Останавливаем 3proxy
-            process = await asyncio.create_subprocess_exec(
-                'sudo', 'pkill', '3proxy',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await process.communicate()
-            
-            # Запускаем 3proxy с новой конфигурацией
-            process = await asyncio.create_subprocess_exec(
-                'sudo', '3proxy', self.config_file,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await process.communicate()
-            return True
-        except Exception:
-            return False
-
-# Инициализируем менеджер прокси
-proxy_manager = ProxyManager()
-
-# Простая система пользователей (в продакшене используйте базу данных)
-users = {
-    'admin': bcrypt.hashpw('admin123'.encode('utf-8'), bcrypt.gensalt())
-}
-
-def login_required(f):
-    """Декоратор для проверки авторизации"""
-    async def decorated_function(request):
-        session = await get_session(request)
-        if 'user_id' not in session:
-            return web.HTTPFound('/login')
-        return await f(request)
-    return decorated_function
-
-async def index(request):
-    """Главная страница"""
-    session = await get_session(request)
-    current_ip = await proxy_manager.get_current_ip()
-    allowed_ips = await proxy_manager.get_allowed_ips()
-    return render_template('index.html', request, {
-        'current_ip': current_ip,
-        'allowed_ips': allowed_ips,
-        'session': session
-    })
-
-async def login(request):
-    """Страница авторизации"""
-    session = await get_session(request)
-    
-    if request.method == 'POST':
-        data = await request.post()
-        username = data.get('username')
-        password = data.get('password')
-        
-        if username in users and bcrypt.checkpw(password.encode('utf-8'), users[username]):
-            session = await new_session(request)
-            session['user_id'] = username
-            return web.HTTPFound('/')
-        else:
-            session = await get_session(request)
-            return render_template('login.html', request, {
-                'error': 'Неверные учетные данные!',
-                'session': session
-            })
-    
-    return render_template('login.html', request, {'session': session})
-
-async def logout(request):
-    """Выход из системы"""
-    session = await get_session(request)
-    session.invalidate()
-    return web.HTTPFound('/login')
-
-async def allow_ip(request):
-    """API для добавления IP в разрешенные"""
-    data = await request.json()
-    ip = data.get('ip')
-    
-    if not ip:
-        return web.json_response({'success': False, 'message': 'IP адрес не указан'})
-    
-    if await proxy_manager.add_allowed_ip(ip):
-        return web.json_response({'success': True, 'message': f'IP {ip} добавлен в разрешенные'})
-    else:
-        return web.json_response({'success': False, 'message': f'IP {ip} уже в списке или неверный формат'})
-
-async def api_current_ip(request):
-    """API для получения текущего IP"""
-    current_ip = await proxy_manager.get_current_ip()
-    return web.json_response({'ip': current_ip})
-
-async def api_allowed_ips(request):
-    """API для получения списка разрешенных IP"""
-    allowed_ips = await proxy_manager.get_allowed_ips()
-    return web.json_response({'ips': allowed_ips})
-
-async def restart_proxy(request):
-    """Перезапуск прокси сервера"""
-    if await proxy_manager.restart_proxy():
-        return web.json_response({'success': True, 'message': 'Прокси сервер перезапущен'})
-    else:
-        return web.json_response({'success': False, 'message': 'Ошибка при перезапуске прокси сервера'})
-
-async def websocket_handler(request):
-    """WebSocket обработчик для авторизации и управления IP"""
-    ws = web.WebSocketResponse()
-    await ws.prepare(request)
-    
-    # Флаг авторизации для текущего WebSocket соединения
-    is_authenticated = False
-    authenticated_user = None
-    
-    try:
-        async for msg in ws:
-            if msg.type == WSMsgType.TEXT:
-                try:
-                    data = json.loads(msg.data)
-                    msg_type = data.get('type')
-                    
-                    # Обработка авторизации
-                    if msg_type == 'auth':
-                        username = data.get('username')
-                        password = data.get('password')
-                        
-                        if username in users and bcrypt.checkpw(password.encode('utf-8'), users[username]):
-                            is_authenticated = True
-                            authenticated_user = username
-                            await ws.send_json({
-                                'type': 'auth_response',
-                                'success': True,
-                                'message': 'Авторизация успешна',
-                                'user': username
-                            })
-                        else:
-                            await ws.send_json({
-                                'type': 'auth_response',
-                                'success': False,
-                                'message': 'Неверные учетные данные'
-                            })
-                    
-                    # Получение текущего IP
-                    elif msg_type == 'get_current_ip':
-                        if not is_authenticated:
-                            await ws.send_json({
-                                'type': 'error',
-                                'message': 'Требуется авторизация'
-                            })
-                            continue
-                        
-                        current_ip = await proxy_manager.get_current_ip()
-                        await ws.send_json({
-                            'type': 'current_ip_response',
-                            'success': True,
-                            'ip': current_ip
-                        })
-                    
-                    # Добавление IP в разрешенные
-                    elif msg_type == 'add_ip':
-                        if not is_authenticated:
-                            await ws.send_json({
-                                'type': 'error',
-                                'message': 'Требуется авторизация'
-                            })
-                            continue
-                        
-                        ip = data.get('ip')
-                        if not ip:
-                            await ws.send_json({
-                                'type': 'add_ip_response',
-                                'success': False,
-                                'message': 'IP адрес не указан'
-                            })
-                            continue
-                        
-                        if await proxy_manager.add_allowed_ip(ip):
-                            await ws.send_json({
-                                'type': 'add_ip_response',
-                                'success': True,
-                                'message': f'IP {ip} добавлен в разрешенные'
-                            })
-                        else:
-                            await ws.send_json({
-                                'type': 'add_ip_response',
-                                'success': False,
-                                'message': f'IP {ip} уже в списке или неверный формат'
-                            })
-                    
-                    # Получение списка разрешенных IP
-                    elif msg_type == 'get_allowed_ips':
-                        if not is_authenticated:
-                            await ws.send_json({
-                                'type': 'error',
-                                'message': 'Требуется авторизация'
-                            })
-                            continue
-                        
-                        allowed_ips = await proxy_manager.get_allowed_ips()
-                        await ws.send_json({
-                            'type': 'allowed_ips_response',
-                            'success': True,
-                            'ips': allowed_ips
-                        })
-                    
-                    # Перезапуск прокси
-                    elif msg_type == 'restart_proxy':
-                        if not is_authenticated:
-                            await ws.send_json({
-                                'type': 'error',
-                                'message': 'Требуется авторизация'
-                            })
-                            continue
-                        
-                        if await proxy_manager.restart_proxy():
-                            await ws.send_json({
-                                'type': 'restart_proxy_response',
-                                'success': True,
-                                'message': 'Прокси сервер перезапущен'
-                            })
-                        else:
-                            await ws.send_json({
-                                'type': 'restart_proxy_response',
-                                'success': False,
-                                'message': 'Ошибка при перезапуске прокси сервера'
-                            })
-                    
-                    else:
-                        await ws.send_json({
-                            'type': 'error',
-                            'message': f'Неизвестный тип сообщения: {msg_type}'
-                        })
-                
-                except json.JSONDecodeError:
-                    await ws.send_json({
-                        'type': 'error',
-                        'message': 'Неверный формат JSON'
-                    })
-                except Exception as e:
-                    await ws.send_json({
-                        'type': 'error',
-                        'message': f'Ошибка обработки запроса: {str(e)}'
-                    })
-            
-            elif msg.type == WSMsgType.ERROR:
-                print(f'WebSocket соединение закрыто с ошибкой: {ws.exception()}')
-    
-    finally:
-        print(f'WebSocket соединение закрыто для пользователя: {authenticated_user or "неавторизованный"}')
-    
-    return ws
-
-def create_app():
-    """Создает и настраивает приложение"""
-    app = web.Application()
-    
-    # Настройка сессий
-    # Используем SimpleCookieStorage (без шифрования)
-    # Для продакшена рекомендуется использовать Redis или другое хранилище сессий с шифрованием
-    setup(app, SimpleCookieStorage())
-    
-    # Настройка CORS
-    cors = cors_setup(app, defaults={
-        "*": ResourceOptions(
-            allow_credentials=True,
-            expose_headers="*",
-            allow_headers="*",
-            allow_methods="*"
-        )
-    })
-    
-    # Настройка шаблонов
-    import os
-    template_path = os.path.join(os.path.dirname(__file__), 'templates')
-    jinja_setup(app, loader=jinja2.FileSystemLoader(template_path))
-    
-    # Маршруты
-    app.router.add_get('/', login_required(index))
-    app.router.add_get('/login', login)
-    app.router.add_post('/login', login)
-    app.router.add_get('/logout', logout)
-    app.router.add_post('/allow_ip', login_required(allow_ip))
-    app.router.add_get('/api/current_ip', login_required(api_current_ip))
-    app.router.add_get('/api/allowed_ips', login_required(api_allowed_ips))
-    app.router.add_post('/restart_proxy', login_required(restart_proxy))
-    
-    # WebSocket маршрут
-    app.router.add_get('/ws', websocket_handler)
-    
-    # Настройка CORS для всех маршрутов (кроме статических)
-    for route in list(app.router.routes()):
-        if not isinstance(route.resource, web.StaticResource):
-            try:
-                cors.add(route)
-            except ValueError:
-                # Пропускаем маршруты, которые уже имеют CORS
-                pass
-    
-    return app
-
-if __name__ == '__main__':
-    app = create_app()
-    web.run_app(app, host='0.0.0.0', port=5000)
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+3proxy Configuration Management Service
+Сервис для управления конфигурацией 3proxy
+"""
+
+import os
+import json
+import subprocess
+import ipaddress
+import asyncio
+import time
+import bisect
+import math
+import heapq
+import tempfile
+import uuid
+import hashlib
+import sqlite3
+import aiofiles
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from aiohttp import web, ClientSession, ClientTimeout, WSMsgType
+from aiohttp_session import setup, get_session, new_session, SimpleCookieStorage
+from aiohttp_cors import setup as cors_setup, ResourceOptions
+from aiohttp_jinja2 import setup as jinja_setup, render_template
+import jinja2
+import bcrypt
+import aiohttp
+
+# Конфигурация
+CONFIG_FILE = 'config/3proxy_ip.cfg'
+ALLOWED_IPS_FILE = 'config/allowed_ips.txt'
+# Хранилище списка разрешенных IP: sqlite (по умолчанию) или text (allowed_ips.txt, как раньше)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+ALLOWLIST_DB = os.environ.get('ALLOWLIST_DB', 'config/allowlist.db')
+# Сгенерированный файл с ACL; подключается в основной конфиг директивой include
+ACL_FILE = 'config/3proxy_acl.cfg'
+# Путь к ACL файлу, как его видит 3proxy (в docker каталог config смонтирован в другое место)
+ACL_INCLUDE_PATH = os.environ.get('ACL_INCLUDE_PATH', ACL_FILE)
+# Путь к основному конфигу, как его видит 3proxy (для директивы monitor)
+PROXY_CONFIG_PATH = os.environ.get('PROXY_CONFIG_PATH', CONFIG_FILE)
+
+# Сервисы определения внешнего IP: опрашиваются параллельно, побеждает первый успешный ответ
+IP_RESOLVERS = [url.strip() for url in os.environ.get(
+    'IP_RESOLVERS', 'https://api.ipify.org,https://ipinfo.io/ip').split(',') if url.strip()]
+IP_RESOLVE_TIMEOUT = 5
+# Время жизни закэшированного внешнего IP (секунды) и кэша неудачной попытки
+CURRENT_IP_TTL = 300
+CURRENT_IP_FAILURE_TTL = 15
+
+# Доверенные обратные прокси (nginx, балансировщик): только им разрешено
+# передавать адрес клиента в X-Forwarded-For / X-Real-IP
+TRUSTED_PROXIES = [ipaddress.ip_network(net.strip(), strict=False) for net in os.environ.get(
+    'TRUSTED_PROXIES',
+    '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16').split(',') if net.strip()]
+
+# Окно группировки изменений перед записью на диск (секунды)
+COMMIT_WINDOW = 0.005
+
+# Способ применения нового конфига 3proxy:
+#   restart - остановка и повторный запуск (рвет активные соединения)
+#   signal  - SIGUSR1 работающему процессу, 3proxy перечитывает конфиг без разрыва соединений
+#   monitor - директива monitor в конфиге, 3proxy сам подхватывает изменения файла
+PROXY_RELOAD_MODE = os.environ.get('PROXY_RELOAD_MODE', 'restart')
+# Бинарник 3proxy и команда повышения прав (пустая строка - запуск без sudo)
+PROXY_BINARY = os.environ.get('PROXY_BINARY', '3proxy')
+PROXY_SUDO = os.environ.get('PROXY_SUDO', 'sudo')
+# Запросы на перезагрузку в пределах окна (секунды) объединяются в одну
+RELOAD_COALESCE_WINDOW = 0.5
+# Применять конфиг автоматически после каждого изменения списка IP
+PROXY_AUTO_RELOAD = os.environ.get('PROXY_AUTO_RELOAD', '').lower() in ('1', 'true', 'yes')
+
+# Файл пользователей: JSON вида {"логин": "bcrypt хеш"}
+USERS_FILE = os.environ.get('USERS_FILE', 'config/users.json')
+# Пользователь по умолчанию admin/admin123; хеш посчитан заранее, чтобы не тратить раунд bcrypt при старте
+DEFAULT_USERS = {
+    'admin': b'$2b$12$Z46hxyiw2c.z47Tk9BWJC.pgwHonFtOLdNRfJJiBCqO2eQ8UTQMIO'
+}
+# Сколько паролей проверяется одновременно (каждая проверка bcrypt - сотни мс CPU)
+AUTH_MAX_CONCURRENCY = int(os.environ.get('AUTH_MAX_CONCURRENCY', '2'))
+# Ограничение попыток входа (token bucket): пополнение в секунду и размер корзины
+AUTH_USER_RATE = 0.2
+AUTH_USER_BURST = 5
+AUTH_SOURCE_RATE = 1.0
+AUTH_SOURCE_BURST = 20
+# Сколько корзин хранить в памяти, самые давние вытесняются
+AUTH_BUCKETS_MAX = 10000
+
+# Сколько последних изменений списка хранить для догоняющих подписчиков
+HUB_HISTORY_SIZE = 1000
+# Размер очереди отправки на одно соединение; при переполнении подписчик получает снимок заново
+HUB_QUEUE_SIZE = 256
+
+# Сколько сообщений одного WebSocket соединения обрабатывается одновременно
+WS_MAX_CONCURRENCY = 8
+
+# Размер страницы списка IP: на главной странице и максимум для API
+INDEX_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Максимальное количество IP в одном пакетном запросе
+MAX_BATCH_SIZE = 10000
+MAX_COMMENT_LENGTH = 500
+# Максимальный срок действия временной записи (ttl), секунд
+MAX_TTL = 365 * 24 * 3600
+# Через сколько секунд повторить удаление истекших записей, если запись на диск не удалась
+EXPIRY_RETRY_DELAY = 30
+# Сколько поглощенных записей перечислять в ответе на добавление сети
+SUBSUMED_REPORT_LIMIT = 100
+
+# Журнал доступа 3proxy (имя без %-макросов, ротация переименованием или усечением)
+ACCESS_LOG_FILE = os.environ.get('ACCESS_LOG_FILE', 'logs/3proxy.log')
+# Позиция чтения журнала и таблица последней активности клиентов
+ACCESS_LOG_STATE = os.environ.get('ACCESS_LOG_STATE', 'config/access_log_state.json')
+ACCESS_LOG_POLL_INTERVAL = 5
+# Журнал читается порциями: не больше ACCESS_LOG_BATCH_BYTES за один заход в поток
+ACCESS_LOG_CHUNK_SIZE = 1024 * 1024
+ACCESS_LOG_BATCH_BYTES = 64 * 1024 * 1024
+# Сколько клиентов помнить; при переполнении забываются давно не активные
+ACCESS_LOG_MAX_CLIENTS = 100000
+ACCESS_LOG_SAVE_INTERVAL = 60
+# Удалять записи без активности дольше указанного числа дней (0 - не удалять)
+IDLE_PRUNE_DAYS = float(os.environ.get('IDLE_PRUNE_DAYS', '0'))
+IDLE_PRUNE_INTERVAL = 3600
+
+# Режим нескольких рабочих процессов (run.py с WORKERS > 1): файлы меняет только писатель,
+# остальные процессы передают ему изменения и получают уведомления через unix сокет
+WORKER_ROLE = os.environ.get('WORKER_ROLE', 'writer')
+WORKER_SOCKET = os.environ.get('WORKER_SOCKET')
+# Пауза перед повторным подключением последователя к писателю
+WORKER_RECONNECT_DELAY = 1
+# Сколько последователь ждет уведомления о своей записи, прежде чем ответить без него
+WORKER_SYNC_TIMEOUT = 5
+
+# Дополнительные узлы 3proxy, на которые раздается список
+NODES_FILE = os.environ.get('NODES_FILE', 'config/nodes.json')
+# Сколько узлов обновляется одновременно
+NODE_CONCURRENCY = 8
+NODE_TIMEOUT = 10
+# Повторы с экспоненциальной паузой; после них узел ждет следующего изменения или сверки
+NODE_RETRIES = 3
+NODE_RETRY_DELAY = 1
+# Как часто сверять версии отстающих узлов
+NODE_RESYNC_INTERVAL = 60
+# Агент узла: принимает список от менеджера и применяет его к локальному 3proxy
+AGENT_PORT = int(os.environ.get('AGENT_PORT', '5001'))
+NODE_AGENT_TOKEN = os.environ.get('NODE_AGENT_TOKEN')
+NODE_STATE_FILE = os.environ.get('NODE_STATE_FILE', 'config/node_state.json')
+
+# Токен для /metrics (Authorization: Bearer ...); без него метрики доступны без авторизации
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Границы корзин гистограмм длительности, секунд
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_metric_value(value):
+    """Значение метрики без потери точности (формат :g оставлял бы 6 значащих цифр)"""
+    if isinstance(value, int):
+        return str(int(value))
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+class Metric:
+    """Метрика в текстовом формате Prometheus.
+    
+    Значения меняются только в потоке цикла событий, поэтому блокировки не нужны:
+    длительность работы в пуле потоков замеряется вокруг await.
+    """
+    
+    kind = None
+    
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        # Значения меток (кортеж) -> значение
+        self._values = {}
+        METRICS.append(self)
+    
+    def _series(self, suffix, label_values, extra=()):
+        pairs = list(zip(self.labels, label_values)) + list(extra)
+        if not pairs:
+            return f'{self.name}{suffix}'
+        rendered = ','.join('{}="{}"'.format(
+            key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs)
+        return f'{self.name}{suffix}{{{rendered}}}'
+    
+    def samples(self):
+        """Строки (имя с метками, значение)"""
+        for label_values, value in self._values.items():
+            yield self._series('', label_values), value
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{series} {format_metric_value(value)}' for series, value in self.samples())
+        return '\n'.join(lines)
+
+class CounterMetric(Metric):
+    kind = 'counter'
+    
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+class GaugeMetric(Metric):
+    """Текущее значение; с function значение вычисляется при каждом чтении /metrics"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+    
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+    
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+    
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+    
+    def samples(self):
+        if self.function is not None:
+            yield self.name, self.function()
+        else:
+            yield from super().samples()
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            # Счетчики по корзинам (последняя - +Inf), сумма
+            series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    
+    def time(self, *label_values):
+        """Контекстный менеджер, замеряющий длительность блока (в том числе с await внутри)"""
+        return MetricTimer(self, label_values)
+    
+    def samples(self):
+        for label_values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                yield self._series('_bucket', label_values, [('le', le)]), cumulative
+            yield self._series('_sum', label_values), total
+            yield self._series('_count', label_values), cumulative
+
+class MetricTimer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+        return False
+
+METRICS = []
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+HTTP_REQUESTS = CounterMetric(
+    'http_requests_total', 'HTTP запросы по маршруту и коду ответа', ('method', 'route', 'status'))
+HTTP_REQUEST_DURATION = HistogramMetric(
+    'http_request_duration_seconds', 'Время обработки HTTP запроса', ('method', 'route'))
+IP_RESOLVER_DURATION = HistogramMetric(
+    'ip_resolver_duration_seconds', 'Время запроса внешнего IP у сервиса', ('resolver', 'outcome'))
+ALLOWLIST_STORAGE_DURATION = HistogramMetric(
+    'allowlist_storage_duration_seconds', 'Время чтения и записи хранилища списка', ('operation',))
+ALLOWLIST_COLLAPSE_DURATION = HistogramMetric(
+    'allowlist_collapse_duration_seconds', 'Время объединения списка в сети для ACL')
+PROXY_CONFIG_WRITE_DURATION = HistogramMetric(
+    'proxy_config_write_duration_seconds', 'Время записи ACL файла и конфига 3proxy')
+PROXY_COMMAND_DURATION = HistogramMetric(
+    'proxy_command_duration_seconds', 'Время выполнения команд управления 3proxy', ('command', 'outcome'))
+PROXY_RELOAD_DURATION = HistogramMetric(
+    'proxy_reload_duration_seconds', 'Время применения конфига 3proxy', ('mode', 'outcome'))
+AUTH_VERIFY_DURATION = HistogramMetric(
+    'auth_bcrypt_duration_seconds', 'Время проверки пароля bcrypt', ('result',))
+AUTH_RESULTS = CounterMetric('auth_attempts_total', 'Попытки входа по результату', ('result',))
+WS_CONNECTIONS = GaugeMetric('websocket_connections', 'Открытые WebSocket соединения')
+WS_MESSAGES = CounterMetric('websocket_messages_total', 'WebSocket сообщения по типу', ('type',))
+WS_MESSAGE_DURATION = HistogramMetric(
+    'websocket_message_duration_seconds', 'Время обработки WebSocket сообщения', ('type',))
+
+def normalize_ip_entry(value, strict=True):
+    """Приводит IP адрес или сеть (CIDR) к каноническому виду, ValueError при неверном формате.
+    
+    Сеть с битами узла (10.0.0.5/24) - скорее опечатка, чем желание открыть всю сеть,
+    поэтому она считается неверной, если не передан strict=False.
+    """
+    if not isinstance(value, str):
+        raise ValueError(f'Ожидалась строка, получено: {value!r}')
+    value = value.strip()
+    if '/' in value:
+        network = ipaddress.ip_network(value, strict=strict)
+        if network.num_addresses == 1:
+            return str(network.network_address)
+        return str(network)
+    return str(ipaddress.ip_address(value))
+
+def _try_normalize_ip_entry(value, strict=True):
+    """Как normalize_ip_entry, но возвращает None вместо исключения"""
+    try:
+        return normalize_ip_entry(value, strict)
+    except ValueError:
+        return None
+
+def atomic_write(path, content):
+    """Атомарно записывает файл: временный файл, fsync и переименование поверх старого"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp создает файл с правами 0600, а 3proxy должен иметь возможность его прочитать
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    
+    # Фиксируем само переименование (на Windows каталог открыть нельзя - пропускаем)
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def parse_ip_entry(entry):
+    """Возвращает сеть для записи списка или None, если запись некорректна"""
+    try:
+        return ipaddress.ip_network(entry, strict=False)
+    except ValueError:
+        return None
+
+def render_acl_target(network):
+    """Форматирует сеть для ACL 3proxy: одиночный адрес без префикса"""
+    if network.num_addresses == 1:
+        return str(network.network_address)
+    return str(network)
+
+def file_digest(path):
+    """SHA-256 содержимого файла или None, если файла нет"""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def render_acl(networks):
+    """Формирует содержимое файла ACL по свернутому списку сетей"""
+    lines = ["# Сгенерировано сервисом управления 3proxy, не редактируйте вручную"]
+    lines.extend(f"allow * {render_acl_target(network)}" for network in networks)
+    return "\n".join(lines) + "\n"
+
+def write_proxy_config(config_file, acl_file, acl_include_path, directives, networks, acl_hash=None):
+    """Обновляет ACL файл, если изменилось его содержимое, и подключает его в основной конфиг.
+    
+    acl_hash - известный хеш ACL файла (None - посчитать по файлу).
+    Возвращает (изменились ли файлы, хеш ACL файла).
+    """
+    changed = False
+    acl = render_acl(networks)
+    digest = hashlib.sha256(acl.encode('utf-8')).hexdigest()
+    if acl_hash is None:
+        acl_hash = file_digest(acl_file)
+    if digest != acl_hash:
+        atomic_write(acl_file, acl)
+        acl_hash = digest
+        changed = True
+    
+    text = ''
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            text = f.read()
+    config = ProxyConfig.parse(text)
+    if config.ensure(f'include {acl_include_path}', before_services=True):
+        # Переход со встроенных правил: убираем те, что теперь дает ACL файл
+        config.drop_allow_rules(networks_cover(networks))
+    for directive in directives:
+        config.ensure(directive)
+    rendered = config.render()
+    if rendered != text:
+        atomic_write(config_file, rendered)
+        changed = True
+    return changed, acl_hash
+
+class ProxyConfig:
+    """Конфиг 3proxy как список строк: сервис добавляет только свои директивы, остальное не трогает"""
+    
+    # Команды, запускающие службы: ACL действуют на службы, объявленные после них
+    SERVICE_COMMANDS = {'proxy', 'socks', 'pop3p', 'ftppr', 'tcppm', 'udppm',
+                        'smtpp', 'admin', 'dnspr', 'auto', 'tlspr'}
+    
+    def __init__(self, lines):
+        self.lines = list(lines)
+    
+    @classmethod
+    def parse(cls, text):
+        return cls(text.splitlines())
+    
+    def render(self):
+        return "\n".join(self.lines) + "\n" if self.lines else ""
+    
+    @staticmethod
+    def command(line):
+        """Имя команды строки или None для пустых строк и комментариев"""
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return None
+        return line.split(None, 1)[0]
+    
+    def has(self, directive):
+        return any(line.strip() == directive for line in self.lines)
+    
+    def ensure(self, directive, before_services=False):
+        """Добавляет директиву, если ее нет: перед первой службой или после начальных комментариев"""
+        if self.has(directive):
+            return False
+        pos = 0
+        if before_services:
+            pos = next((i for i, line in enumerate(self.lines)
+                        if self.command(line) in self.SERVICE_COMMANDS), len(self.lines))
+        else:
+            while pos < len(self.lines) and self.lines[pos].strip().startswith('#'):
+                pos += 1
+        self.lines.insert(pos, directive)
+        return True
+    
+    def drop_allow_rules(self, covered):
+        """Удаляет правила вида 'allow * <сеть>', для которых covered(сеть) истинно"""
+        kept = []
+        for line in self.lines:
+            tokens = line.split()
+            if len(tokens) == 3 and tokens[:2] == ['allow', '*']:
+                network = parse_ip_entry(tokens[2])
+                if network is not None and covered(network):
+                    continue
+            kept.append(line)
+        changed = len(kept) != len(self.lines)
+        self.lines = kept
+        return changed
+
+def networks_cover(networks):
+    """Возвращает проверку, что сеть целиком лежит внутри одной из непересекающихся сетей"""
+    keys = sorted((n.version, int(n.network_address), int(n.broadcast_address)) for n in networks)
+    def covered(network):
+        start = int(network.network_address)
+        pos = bisect.bisect_right(keys, (network.version, start, float('inf'))) - 1
+        return (pos >= 0 and keys[pos][0] == network.version
+                and keys[pos][2] >= int(network.broadcast_address))
+    return covered
+
+class AllowlistIndex:
+    """Сортированный индекс записей списка разрешенных IP для поиска по диапазонам"""
+    
+    def __init__(self, entries=()):
+        # (version, start, end, entry), отсортировано по началу диапазона
+        self._keys = []
+        # Записи в строковом порядке, для поиска по префиксу
+        self._names = []
+        self._networks = {}
+        # (version, prefixlen) -> количество сетей такой длины, для поиска покрывающих сетей
+        self._prefixes = Counter()
+        for entry in entries:
+            network = parse_ip_entry(entry)
+            if network is not None:
+                self._networks[entry] = network
+                self._prefixes[(network.version, network.prefixlen)] += 1
+                self._keys.append(self._key(entry, network))
+        self._keys.sort()
+        self._names = sorted(self._networks)
+    
+    @staticmethod
+    def _key(entry, network):
+        return (network.version, int(network.network_address),
+                int(network.broadcast_address), entry)
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def add(self, entry, network):
+        """Добавляет запись в индекс"""
+        if entry in self._networks:
+            return
+        self._networks[entry] = network
+        self._prefixes[(network.version, network.prefixlen)] += 1
+        bisect.insort(self._keys, self._key(entry, network))
+        bisect.insort(self._names, entry)
+    
+    def remove(self, entry):
+        """Удаляет запись из индекса"""
+        network = self._networks.pop(entry, None)
+        if network is None:
+            return
+        self._prefixes[(network.version, network.prefixlen)] -= 1
+        key = self._key(entry, network)
+        pos = bisect.bisect_left(self._keys, key)
+        if pos < len(self._keys) and self._keys[pos] == key:
+            del self._keys[pos]
+        pos = bisect.bisect_left(self._names, entry)
+        if pos < len(self._names) and self._names[pos] == entry:
+            del self._names[pos]
+    
+    def lookup(self, address):
+        """Возвращает запись, в которую входит адрес, или None"""
+        entry = str(address)
+        if entry in self._networks:
+            return entry
+        return self.covering(ipaddress.ip_network(address))
+    
+    def covering(self, network):
+        """Возвращает самую широкую запись, которая целиком покрывает сеть, или None"""
+        return next(self.coverings(network), None)
+    
+    def coverings(self, network):
+        """Все записи, которые целиком покрывают сеть, от самой широкой к самой узкой"""
+        prefixes = sorted(prefixlen for (version, prefixlen), count in self._prefixes.items()
+                          if count and version == network.version and prefixlen < network.prefixlen)
+        for prefixlen in prefixes:
+            entry = str(network.supernet(new_prefix=prefixlen))
+            if entry in self._networks:
+                yield entry
+    
+    def subsumed(self, network):
+        """Возвращает записи, которые целиком лежат внутри сети"""
+        start = int(network.network_address)
+        end = int(network.broadcast_address)
+        pos = bisect.bisect_left(self._keys, (network.version, start))
+        result = []
+        for version, key_start, key_end, entry in self._keys[pos:]:
+            if version != network.version or key_start > end:
+                break
+            if key_end <= end and entry != str(network):
+                result.append(entry)
+        return result
+    
+    def query(self, network=None, prefix=None, after=None, limit=None):
+        """Страница записей: внутри сети (в порядке адресов) или по префиксу строки.
+        
+        after - последняя запись предыдущей страницы. Возвращает (записи, курсор следующей страницы).
+        """
+        if prefix is not None:
+            entries = self._query_prefix(prefix, after, limit)
+        else:
+            entries = self._query_range(network, after, limit)
+        next_cursor = entries[-1] if limit and len(entries) == limit else None
+        return entries, next_cursor
+    
+    def _query_range(self, network, after, limit):
+        pos = 0
+        if after is not None:
+            after_network = parse_ip_entry(after)
+            if after_network is None:
+                raise ValueError(f'Неверный курсор: {after}')
+            pos = bisect.bisect_right(self._keys, self._key(after, after_network))
+        if network is not None:
+            end = int(network.broadcast_address)
+            pos = max(pos, bisect.bisect_left(self._keys, (network.version, int(network.network_address))))
+        
+        result = []
+        for i in range(pos, len(self._keys)):
+            version, start, key_end, entry = self._keys[i]
+            if network is not None:
+                if version != network.version or start > end:
+                    break
+                if key_end > end:
+                    continue
+            result.append(entry)
+            if limit and len(result) >= limit:
+                break
+        return result
+    
+    def _query_prefix(self, prefix, after, limit):
+        pos = bisect.bisect_left(self._names, prefix)
+        if after is not None:
+            pos = max(pos, bisect.bisect_right(self._names, after))
+        
+        result = []
+        for i in range(pos, len(self._names)):
+            entry = self._names[i]
+            if not entry.startswith(prefix):
+                break
+            result.append(entry)
+            if limit and len(result) >= limit:
+                break
+        return result
+    
+    def snapshot(self):
+        """Копия сортированных ключей и сетей записей - для collapse_keys в отдельном потоке"""
+        return list(self._keys), dict(self._networks)
+    
+    def collapse(self):
+        """Сворачивает записи в минимальный набор префиксов, объединяя смежные и пересекающиеся диапазоны"""
+        return collapse_keys(self._keys, self._networks)
+
+def collapse_keys(keys, networks_by_entry):
+    """Сворачивает сортированные ключи AllowlistIndex в минимальный набор префиксов.
+    
+    Запись, которая ни с чем не объединилась, берется готовой из networks_by_entry: на большом
+    списке новые объекты ipaddress для каждой записи заметно нагружают сборщик мусора.
+    """
+    ranges = []
+    for version, start, end, entry in keys:
+        if ranges and ranges[-1][0] == version and start <= ranges[-1][2] + 1:
+            if end > ranges[-1][2]:
+                ranges[-1][2] = end
+            ranges[-1][3] = None
+        else:
+            ranges.append([version, start, end, entry])
+    
+    networks = []
+    for version, start, end, entry in ranges:
+        if entry is not None:
+            networks.append(networks_by_entry[entry])
+            continue
+        address = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        networks.extend(ipaddress.summarize_address_range(address(start), address(end)))
+    return networks
+
+class ReloadStrategy:
+    """Способ применения конфигурации 3proxy"""
+    
+    name = None
+    graceful = False
+    
+    def __init__(self, binary=PROXY_BINARY, sudo=PROXY_SUDO):
+        self.binary = binary
+        self.sudo = sudo
+    
+    @property
+    def process_name(self):
+        return os.path.basename(self.binary)
+    
+    def directives(self, config_path, acl_path):
+        """Директивы, которые должны присутствовать в конфиге для этого способа (пути - как их видит 3proxy)"""
+        return []
+    
+    async def _run(self, *args):
+        """Запускает команду и возвращает код завершения и stderr"""
+        command = ([self.sudo] if self.sudo else []) + list(args)
+        name = os.path.basename(args[0])
+        start = time.perf_counter()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await process.communicate()
+        except OSError as e:
+            PROXY_COMMAND_DURATION.observe(time.perf_counter() - start, name, 'error')
+            return {'command': ' '.join(command), 'returncode': None, 'stderr': str(e)}
+        PROXY_COMMAND_DURATION.observe(time.perf_counter() - start, name, process.returncode)
+        return {
+            'command': ' '.join(command),
+            'returncode': process.returncode,
+            'stderr': stderr.decode('utf-8', 'replace').strip()
+        }
+    
+    async def _start(self, config_file, steps):
+        """Запускает 3proxy с указанным конфигом"""
+        step = await self._run(self.binary, config_file)
+        steps.append(step)
+        return step['returncode'] == 0
+    
+    async def reload(self, config_file):
+        """Применяет конфиг, возвращает (успех, выполненные команды)"""
+        raise NotImplementedError
+
+class RestartReload(ReloadStrategy):
+    """Остановка и повторный запуск 3proxy"""
+    
+    name = 'restart'
+    
+    async def reload(self, config_file):
+        steps = [await self._run('pkill', '-x', self.process_name)]
+        # pkill возвращает 1, если процесс не был запущен - это не ошибка
+        if steps[-1]['returncode'] not in (0, 1):
+            return False, steps
+        return await self._start(config_file, steps), steps
+
+class SignalReload(ReloadStrategy):
+    """Перечитывание конфига по SIGUSR1 без разрыва активных соединений"""
+    
+    name = 'signal'
+    graceful = True
+    
+    async def reload(self, config_file):
+        steps = [await self._run('pkill', '-USR1', '-x', self.process_name)]
+        if steps[-1]['returncode'] == 0:
+            return True, steps
+        # Процесс не запущен - сигналить некому, запускаем
+        if steps[-1]['returncode'] == 1:
+            return await self._start(config_file, steps), steps
+        return False, steps
+
+class MonitorReload(ReloadStrategy):
+    """3proxy сам следит за файлом конфига (директива monitor), нужно лишь чтобы он был запущен"""
+    
+    name = 'monitor'
+    graceful = True
+    
+    def directives(self, config_path, acl_path):
+        return [f'monitor {config_path}', f'monitor {acl_path}']
+    
+    async def reload(self, config_file):
+        steps = [await self._run('pgrep', '-x', self.process_name)]
+        if steps[-1]['returncode'] == 0:
+            return True, steps
+        if steps[-1]['returncode'] == 1:
+            return await self._start(config_file, steps), steps
+        return False, steps
+
+RELOAD_STRATEGIES = {cls.name: cls for cls in (RestartReload, SignalReload, MonitorReload)}
+
+class ProxyReloader:
+    """Объединяет запросы на перезагрузку 3proxy, пришедшие в пределах окна, в одну"""
+    
+    def __init__(self, strategy, config_file, window=RELOAD_COALESCE_WINDOW):
+        self.strategy = strategy
+        self.config_file = config_file
+        self.window = window
+        self._pending = None
+        self._pending_requests = 0
+        self._lock = None
+    
+    async def request(self):
+        """Запрашивает перезагрузку и ждет ее результата"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if self._pending is None:
+            self._pending = asyncio.get_running_loop().create_future()
+            self._pending_requests = 0
+            asyncio.ensure_future(self._run(self._pending))
+        self._pending_requests += 1
+        return await asyncio.shield(self._pending)
+    
+    def schedule(self):
+        """Запрашивает перезагрузку, не дожидаясь результата"""
+        task = asyncio.ensure_future(self.request())
+        task.add_done_callback(self._report)
+    
+    @staticmethod
+    def _report(task):
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            print(f'Ошибка автоматической перезагрузки 3proxy: {task.exception()}')
+        elif not task.result()['success']:
+            print(f'Автоматическая перезагрузка 3proxy не удалась: {task.result()}')
+    
+    async def _run(self, future):
+        await asyncio.sleep(self.window)
+        async with self._lock:
+            # Запросы, пришедшие с этого момента, получат следующую перезагрузку
+            self._pending = None
+            requests = self._pending_requests
+            start = time.perf_counter()
+            try:
+                success, steps = await self.strategy.reload(self.config_file)
+            except Exception as e:
+                PROXY_RELOAD_DURATION.observe(time.perf_counter() - start, self.strategy.name, 'error')
+                future.set_exception(e)
+                return
+            PROXY_RELOAD_DURATION.observe(time.perf_counter() - start, self.strategy.name,
+                                          'ok' if success else 'failed')
+            future.set_result({
+                'success': success,
+                'mode': self.strategy.name,
+                'returncode': steps[-1]['returncode'] if steps else None,
+                'stderr': '\n'.join(step['stderr'] for step in steps if step['stderr']),
+                'steps': steps,
+                'coalesced': requests
+            })
+
+class Subscription:
+    """Подписка одного соединения на изменения списка разрешенных IP"""
+    
+    # Маркер в очереди: вместо накопленных изменений отправить полный снимок
+    RESYNC = object()
+    
+    def __init__(self, hub, send, queue_size=HUB_QUEUE_SIZE):
+        self.hub = hub
+        self.send = send
+        # Эпоха и версия, которые клиент уже получил
+        self.epoch = None
+        self.version = None
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = asyncio.ensure_future(self._run())
+    
+    def push(self, event):
+        """Ставит событие в очередь отправки, не дожидаясь медленного клиента"""
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.resync()
+    
+    def resync(self):
+        """Отбрасывает накопленные изменения и отправляет клиенту свежий снимок"""
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(self.RESYNC)
+    
+    async def _run(self):
+        while True:
+            event = await self._queue.get()
+            if event is self.RESYNC:
+                version, ips = await self.hub.snapshot()
+                event = {'type': 'allowlist_snapshot', 'epoch': self.hub.epoch, 'version': version, 'ips': ips}
+            elif event['epoch'] == self.epoch and self.version is not None and event['version'] <= self.version:
+                # Уже учтено в снимке
+                continue
+            try:
+                await self.send(event)
+            except ConnectionError:
+                # Соединение закрыто - подписка будет снята обработчиком соединения
+                return
+            self.epoch, self.version = event['epoch'], event['version']
+    
+    def close(self):
+        self._task.cancel()
+
+class AllowlistHub:
+    """Рассылка изменений списка разрешенных IP подписанным соединениям"""
+    
+    def __init__(self, snapshot, history_size=HUB_HISTORY_SIZE):
+        # snapshot - корутина, возвращающая (версия, список IP)
+        self.snapshot = snapshot
+        self.version = 0
+        # Версии сравнимы только в пределах одного запуска
+        self.epoch = uuid.uuid4().hex[:8]
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+        # Функции без аргументов, вызываемые при каждом изменении версии
+        self.listeners = []
+    
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
+    
+    def publish(self, added, removed, version=None, updated=()):
+        """Фиксирует новую версию списка и рассылает изменение подписчикам.
+        
+        updated - записи, у которых изменились только метаданные (продленный срок действия).
+        """
+        self.version = self.version + 1 if version is None else version
+        event = {
+            'type': 'allowlist_delta',
+            'epoch': self.epoch,
+            'version': self.version,
+            'added': added,
+            'removed': removed,
+            'updated': list(updated)
+        }
+        self._history.append(event)
+        for subscription in self._subscribers:
+            subscription.push(event)
+        self._notify()
+    
+    def invalidate(self):
+        """Список изменился непредсказуемо: история сбрасывается, подписчики получают снимок"""
+        self.version += 1
+        self._history.clear()
+        for subscription in self._subscribers:
+            subscription.resync()
+        self._notify()
+    
+    def follow(self, epoch, version):
+        """Переходит на эпоху и версию писателя (в процессе-последователе), подписчики получают снимок"""
+        self.epoch = epoch
+        self.version = version
+        self._history.clear()
+        for subscription in self._subscribers:
+            subscription.resync()
+        self._notify()
+    
+    def events_since(self, version):
+        """Возвращает изменения после указанной версии или None, если история их уже не хранит"""
+        if version == self.version:
+            return []
+        if not isinstance(version, int) or version > self.version:
+            return None
+        if not self._history or self._history[0]['version'] > version + 1:
+            return None
+        return [event for event in self._history if event['version'] > version]
+    
+    def subscribe(self, send, since=None, epoch=None):
+        """Подписывает соединение; начиная с версии since, если она из текущей эпохи, иначе со снимка"""
+        subscription = Subscription(self, send)
+        events = self.events_since(since) if since is not None and epoch == self.epoch else None
+        if events is None:
+            subscription.resync()
+        else:
+            subscription.epoch, subscription.version = epoch, since
+            for event in events:
+                subscription.push(event)
+        self._subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+        subscription.close()
+
+class AllowlistStorage:
+    """Хранилище списка разрешенных IP.
+    
+    Записи хранятся вместе с метаданными: added_by, added_at, comment, expires_at.
+    Методы синхронные, менеджер вызывает их в отдельном потоке.
+    """
+    
+    # Нужен ли save() полный список записей (иначе достаточно изменений)
+    full_rewrite = False
+    
+    def changed(self):
+        """Изменилось ли хранилище в обход сервиса с последней загрузки или записи"""
+        raise NotImplementedError
+    
+    def invalidate(self):
+        """Заставляет следующую проверку changed() вернуть True"""
+        raise NotImplementedError
+    
+    def load(self):
+        """Возвращает dict запись -> метаданные в порядке добавления"""
+        raise NotImplementedError
+    
+    def load_metadata(self, entries):
+        """Возвращает метаданные только указанных записей (тех, что есть в хранилище)"""
+        raise NotImplementedError
+    
+    def save(self, entries, added, removed):
+        """Надежно сохраняет изменения: added - dict запись -> метаданные (новые и измененные), removed - список записей"""
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+class TextFileStorage(AllowlistStorage):
+    """Список в текстовом файле, по записи на строку; метаданные не сохраняются"""
+    
+    full_rewrite = True
+    
+    def __init__(self, path=ALLOWED_IPS_FILE):
+        self.path = path
+        # (st_ino, st_mtime_ns, st_size) файла на момент последней загрузки или записи
+        self._stamp = None
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write("# Разрешенные IP адреса\n")
+    
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    def changed(self):
+        stamp = self._file_stamp()
+        return stamp is None or stamp != self._stamp
+    
+    def invalidate(self):
+        self._stamp = None
+    
+    def load(self):
+        stamp = self._file_stamp()
+        allowed_ips = {}
+        if stamp is not None:
+            with open(self.path, 'r') as f:
+                content = f.read()
+            for line in content.splitlines():
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    allowed_ips[line] = None
+        self._stamp = stamp
+        return allowed_ips
+    
+    def load_metadata(self, entries):
+        return dict.fromkeys(entries)
+    
+    def save(self, entries, added, removed):
+        content = "# Разрешенные IP адреса\n" + "".join(entry + "\n" for entry in entries)
+        atomic_write(self.path, content)
+        self._stamp = self._file_stamp()
+
+class SQLiteStorage(AllowlistStorage):
+    """Список во встроенной базе SQLite (WAL): вставка и удаление по индексу, стоимость не растет со списком"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS allowed_ips (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entry TEXT NOT NULL UNIQUE,
+            added_by TEXT,
+            added_at REAL NOT NULL,
+            comment TEXT,
+            expires_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS allowed_ips_expires_at
+            ON allowed_ips (expires_at) WHERE expires_at IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+    
+    METADATA_FIELDS = ('added_by', 'added_at', 'comment', 'expires_at')
+    # Сколько записей запрашивать одним SELECT ... IN (ограничение на число параметров)
+    QUERY_CHUNK = 500
+    
+    def __init__(self, path=ALLOWLIST_DB, import_from=ALLOWED_IPS_FILE):
+        self.path = path
+        self.import_from = import_from
+        self._conn = None
+        # PRAGMA data_version меняется только при коммитах других соединений
+        self._data_version = None
+    
+    def _connection(self):
+        """Открывает базу при первом обращении (не при импорте модуля)"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Ответ клиенту отправляется после записи - коммит должен пережить сбой питания
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+            if self.import_from:
+                self.import_text_file(self.import_from)
+        return self._conn
+    
+    def import_text_file(self, path):
+        """Однократно переносит записи из allowed_ips.txt; возвращает число перенесенных"""
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM settings WHERE key = 'imported_text_file'").fetchone():
+            return 0
+        imported = TextFileStorage(path).load() if os.path.exists(path) else {}
+        added_at = os.path.getmtime(path) if os.path.exists(path) else time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'INSERT OR IGNORE INTO allowed_ips (entry, added_by, added_at) VALUES (?, ?, ?)',
+                ((entry, 'import', added_at) for entry in imported))
+            conn.execute("INSERT INTO settings (key, value) VALUES ('imported_text_file', ?)", (path,))
+        return len(imported)
+    
+    def changed(self):
+        version = self._connection().execute('PRAGMA data_version').fetchone()[0]
+        return version != self._data_version
+    
+    def invalidate(self):
+        self._data_version = None
+    
+    def load(self):
+        conn = self._connection()
+        self._data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        rows = conn.execute(
+            'SELECT entry, added_by, added_at, comment, expires_at FROM allowed_ips ORDER BY id')
+        return {row[0]: dict(zip(self.METADATA_FIELDS, row[1:])) for row in rows}
+    
+    def load_metadata(self, entries):
+        conn = self._connection()
+        metadata = {}
+        for i in range(0, len(entries), self.QUERY_CHUNK):
+            chunk = entries[i:i + self.QUERY_CHUNK]
+            rows = conn.execute(
+                'SELECT entry, added_by, added_at, comment, expires_at FROM allowed_ips '
+                f'WHERE entry IN ({", ".join("?" * len(chunk))})', chunk)
+            metadata.update((row[0], dict(zip(self.METADATA_FIELDS, row[1:]))) for row in rows)
+        return metadata
+    
+    def save(self, entries, added, removed):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('DELETE FROM allowed_ips WHERE entry = ?', ((entry,) for entry in removed))
+            # Upsert сохраняет id, а с ним и порядок добавления при продлении срока
+            conn.executemany(
+                'INSERT INTO allowed_ips (entry, added_by, added_at, comment, expires_at) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT (entry) DO UPDATE SET '
+                'added_by = excluded.added_by, added_at = excluded.added_at, '
+                'comment = excluded.comment, expires_at = excluded.expires_at',
+                [(entry, *self._metadata_row(meta)) for entry, meta in added.items()])
+    
+    @staticmethod
+    def _metadata_row(meta):
+        meta = meta or {}
+        return (meta.get('added_by'), meta.get('added_at') or time.time(),
+                meta.get('comment'), meta.get('expires_at'))
+    
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+STORAGE_BACKENDS = {'sqlite': SQLiteStorage, 'text': TextFileStorage}
+
+class ExpiryScheduler:
+    """Сроки действия записей в min-куче.
+    
+    Одна фоновая задача спит до ближайшего срока и передает все истекшие к этому
+    моменту записи одним вызовом expire(entries); список целиком не просматривается.
+    Отмененные и перенесенные сроки остаются в куче и пропускаются при извлечении.
+    """
+    
+    def __init__(self, expire):
+        self.expire = expire
+        self._heap = []
+        # Действующий срок каждой записи; элементы кучи, не совпадающие с ним, устарели
+        self._deadlines = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def __len__(self):
+        return len(self._deadlines)
+    
+    def schedule(self, entry, deadline):
+        """Назначает (или снимает, если deadline равен None) срок действия записи"""
+        if deadline is None:
+            self.cancel(entry)
+            return
+        self._deadlines[entry] = deadline
+        heapq.heappush(self._heap, (deadline, entry))
+        if self._heap[0] == (deadline, entry):
+            # Новый ближайший срок - будим задачу, чтобы она пересчитала время сна
+            self._wakeup.set()
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+    
+    def cancel(self, entry):
+        self._deadlines.pop(entry, None)
+    
+    def reset(self, deadlines):
+        """Заменяет все сроки (после перечитывания хранилища), deadlines - dict запись -> срок"""
+        self._deadlines = dict(deadlines)
+        self._compact()
+        self._wakeup.set()
+    
+    def _compact(self):
+        self._heap = [(deadline, entry) for entry, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+    
+    def next_deadline(self):
+        """Ближайший действующий срок или None"""
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+    
+    def pop_due(self, now):
+        """Извлекает все записи со сроком не позже now"""
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                return due
+            _, entry = heapq.heappop(self._heap)
+            del self._deadlines[entry]
+            due.append(entry)
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            due = self.pop_due(time.time())
+            if not due:
+                continue
+            try:
+                await self.expire(due)
+            except Exception as e:
+                print(f"Ошибка удаления истекших записей: {e}")
+                retry_at = time.time() + EXPIRY_RETRY_DELAY
+                for entry in due:
+                    self._deadlines.setdefault(entry, retry_at)
+                    heapq.heappush(self._heap, (self._deadlines[entry], entry))
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+@lru_cache(maxsize=1024)
+def _parse_log_time(date, clock, zone):
+    """Время из полей %d-%m-%Y %H:%M:%S [%z] формата журнала 3proxy по умолчанию, None если это не дата"""
+    try:
+        if zone:
+            return datetime.strptime(f'{date} {clock} {zone}', '%d-%m-%Y %H:%M:%S %z').timestamp()
+        return time.mktime(time.strptime(f'{date} {clock}', '%d-%m-%Y %H:%M:%S'))
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=4096)
+def _parse_log_seconds(seconds):
+    """Время из %y%m%d%H%M%S в GMT, None если это не дата"""
+    try:
+        return datetime.strptime(seconds, '%y%m%d%H%M%S').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+def _parse_log_stamp(stamp):
+    """Время из поля %y%m%d%H%M%S.%. (logformat 3proxy по умолчанию, время в GMT), None если это не оно"""
+    if len(stamp) != 16 or stamp[12] != '.' or not (stamp[:12] + stamp[13:]).isdigit():
+        return None
+    seconds = _parse_log_seconds(stamp[:12])
+    return None if seconds is None else seconds + int(stamp[13:]) / 1000
+
+def parse_access_log_line(line):
+    """Разбирает строку журнала 3proxy: (адрес клиента как в журнале, время или None).
+    
+    Клиент - первое поле вида адрес:порт (%C:%c), где адрес - IP. Время - первое поле,
+    если это Unix timestamp (logformat, начинающийся с %t), время logformat по умолчанию
+    (G%y%m%d%H%M%S.%.) или дата и время формата без logformat (%d-%m-%Y %H:%M:%S).
+    """
+    # Клиент в начале строки - остальные поля (запрос, URL) не разбираем
+    fields = line.split(None, 8)
+    if len(fields) < 2:
+        return None
+    timestamp = None
+    try:
+        value = float(fields[0])
+        if 1e9 <= value < 1e10:
+            timestamp = value
+        else:
+            timestamp = _parse_log_stamp(fields[0])
+    except ValueError:
+        if len(fields) > 2 and ':' in fields[1]:
+            zone = fields[2] if fields[2][:1] in '+-' and fields[2][1:].isdigit() else None
+            timestamp = _parse_log_time(fields[0], fields[1], zone)
+    for field in fields[1:]:
+        # Время (12:34:56) тоже похоже на адрес:порт - берем только поля с IP
+        host, sep, port = field.rpartition(':')
+        if sep and host and port.isdigit() and _parse_ip(host) is not None:
+            return host, timestamp
+    return None
+
+class AccessLogTailer:
+    """Инкрементальное чтение журнала доступа 3proxy.
+    
+    Продолжает с сохраненной позиции, дочитывает старый файл после ротации
+    и ведет таблицу клиент -> [время последнего запроса, число запросов].
+    """
+    
+    def __init__(self, path=ACCESS_LOG_FILE, state_file=ACCESS_LOG_STATE,
+                 chunk_size=ACCESS_LOG_CHUNK_SIZE, batch_bytes=ACCESS_LOG_BATCH_BYTES,
+                 max_clients=ACCESS_LOG_MAX_CLIENTS):
+        self.path = path
+        self.state_file = state_file
+        self.chunk_size = chunk_size
+        self.batch_bytes = batch_bytes
+        self.max_clients = max_clients
+        self.offset = 0
+        self.inode = None
+        # Время первой и последней разобранной строки с клиентом: активность известна только
+        # в этом промежутке, пока строк не было - неизвестна совсем
+        self.since = None
+        self.last_line = None
+        # Порядок - от давно активных к недавним
+        self.clients = OrderedDict()
+        self._file = None
+        self._load_state()
+    
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self.offset = state['offset']
+            self.inode = state['inode']
+            # Старые состояния без last_line хранили время запуска, а не разобранных строк
+            if state.get('last_line') is not None:
+                self.since = state['since']
+                self.last_line = state['last_line']
+            clients = sorted(state['clients'].items(), key=lambda item: item[1][0])
+            self.clients = OrderedDict((ip, list(seen)) for ip, seen in clients)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Состояние журнала доступа не загружено, читаем журнал заново: {e}")
+    
+    def state(self):
+        """Снимок состояния для сохранения (вызывается в цикле событий)"""
+        return {
+            'offset': self.offset,
+            'inode': self.inode,
+            'since': self.since,
+            'last_line': self.last_line,
+            'clients': dict(self.clients)
+        }
+    
+    def save_state(self, state):
+        atomic_write(self.state_file, json.dumps(state))
+    
+    def _open(self):
+        """Открывает журнал, продолжая с сохраненной позиции, если это тот же файл"""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        st = os.fstat(f.fileno())
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.offset = 0
+        f.seek(self.offset)
+        self._file = f
+        self.inode = st.st_ino
+        return True
+    
+    def _rotated(self):
+        """Заменен ли файл журнала новым (ротация переименованием) или усечен"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # Старый файл переименован, а новый еще не создан - ждем
+            return False
+        if st.st_ino != self.inode:
+            return True
+        if st.st_size < self.offset:
+            # Усечение на месте (copytruncate) - читаем сначала
+            self.offset = 0
+            self._file.seek(0)
+        return False
+    
+    def read_batch(self):
+        """Читает очередную порцию журнала (в отдельном потоке).
+        
+        Возвращает (dict клиент -> (последнее время, число запросов), остались ли непрочитанные данные).
+        """
+        batch = {}
+        budget = self.batch_bytes
+        while budget > 0:
+            if self._file is None and not self._open():
+                break
+            data = self._file.read(min(self.chunk_size, budget))
+            if not data:
+                if not self._rotated():
+                    break
+                # Старый файл дочитан до конца - переходим к новому
+                self._file.close()
+                self._file = None
+                continue
+            budget -= len(data)
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                if len(data) < self.chunk_size:
+                    # Неполная строка - дочитаем, когда 3proxy ее допишет
+                    self._file.seek(self.offset)
+                    break
+                # Строка длиннее порции - пропускаем ее часть
+                end = len(data)
+            else:
+                self._parse(data[:end], batch)
+            self.offset += end
+            self._file.seek(self.offset)
+        return batch, budget <= 0
+    
+    @staticmethod
+    def _parse(data, batch):
+        for line in data.decode('utf-8', 'replace').splitlines():
+            parsed = parse_access_log_line(line)
+            if parsed is None:
+                continue
+            host, timestamp = parsed
+            # Строка без разобранного времени не сдвигает время активности: при чтении старого
+            # журнала время разбора сделало бы всех его клиентов активными только что
+            last_seen, hits = batch.get(host, (None, 0))
+            if timestamp is not None and (last_seen is None or timestamp > last_seen):
+                last_seen = timestamp
+            batch[host] = (last_seen, hits + 1)
+    
+    def merge(self, batch):
+        """Добавляет прочитанную порцию в таблицу клиентов (вызывается в цикле событий)"""
+        for host, (last_seen, hits) in batch.items():
+            ip = _parse_ip(host)
+            if ip is None:
+                continue
+            if last_seen is None:
+                # Время неизвестно - учитываем только запросы уже известного клиента
+                seen = self.clients.get(str(ip))
+                if seen is not None:
+                    seen[1] += hits
+                continue
+            # Для начала учета берем время последнего запроса клиента - оценка с запасом
+            self.since = last_seen if self.since is None else min(self.since, last_seen)
+            self.last_line = last_seen if self.last_line is None else max(self.last_line, last_seen)
+            ip = str(ip)
+            seen = self.clients.pop(ip, None)
+            if seen is None:
+                seen = [last_seen, hits]
+            else:
+                seen[0] = max(seen[0], last_seen)
+                seen[1] += hits
+            self.clients[ip] = seen
+            if len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+    
+    def covers(self, start):
+        """Разобраны ли строки журнала за весь промежуток от start до последнего чтения"""
+        if self.since is None or self.since > start or self.last_line < start:
+            return False
+        return os.path.exists(self.path)
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class ProxyNode:
+    """Узел 3proxy, на который раздается список разрешенных IP.
+    
+    epoch и version - версия списка, которую узел уже применил (None - неизвестно).
+    """
+    
+    kind = None
+    
+    def __init__(self, name):
+        self.name = name
+        self.epoch = None
+        self.version = None
+        self.status = 'pending'
+        self.error = None
+        self.synced_at = None
+        self.task = None
+    
+    @property
+    def target(self):
+        raise NotImplementedError
+    
+    async def sync(self, fleet):
+        """Доводит узел до текущей версии списка, исключение - при ошибке"""
+        raise NotImplementedError
+    
+    def info(self, epoch, version):
+        """Состояние узла для API"""
+        behind = None
+        if self.epoch == epoch and self.version is not None:
+            behind = version - self.version
+        return {
+            'name': self.name,
+            'type': self.kind,
+            'target': self.target,
+            'version': self.version if self.epoch == epoch else None,
+            'behind': behind,
+            'status': self.status,
+            'error': self.error,
+            'synced_at': self.synced_at
+        }
+    
+    @staticmethod
+    def from_config(spec):
+        """Создает узел по описанию из nodes.json, ValueError если описание неверное"""
+        if not isinstance(spec, dict) or not spec.get('name'):
+            raise ValueError(f'У узла должно быть имя: {spec!r}')
+        kind = spec.get('type', 'local')
+        if kind == 'local':
+            if not spec.get('config_file'):
+                raise ValueError(f'Для локального узла {spec["name"]} не указан config_file')
+            if spec.get('reload') and spec['reload'] not in RELOAD_STRATEGIES:
+                raise ValueError(f'Неизвестный способ перезагрузки узла {spec["name"]}: {spec["reload"]}')
+            return LocalNode(spec['name'], spec['config_file'], spec.get('acl_file'),
+                             spec.get('acl_include_path'), spec.get('reload'),
+                             spec.get('binary', PROXY_BINARY), spec.get('sudo', PROXY_SUDO),
+                             spec.get('config_path'))
+        if kind == 'agent':
+            if not spec.get('url'):
+                raise ValueError(f'Для агента {spec["name"]} не указан url')
+            return AgentNode(spec['name'], spec['url'], spec.get('token'))
+        raise ValueError(f'Неизвестный тип узла {spec["name"]}: {kind}')
+
+class LocalNode(ProxyNode):
+    """Узел с конфигом в локальной файловой системе: ACL файл перерисовывается целиком"""
+    
+    kind = 'local'
+    
+    def __init__(self, name, config_file, acl_file=None, acl_include_path=None, reload=None,
+                 binary=PROXY_BINARY, sudo=PROXY_SUDO, config_path=None):
+        super().__init__(name)
+        self.config_file = config_file
+        self.config_path = config_path or config_file
+        self.acl_file = acl_file or os.path.join(os.path.dirname(config_file), '3proxy_acl.cfg')
+        self.acl_include_path = acl_include_path or self.acl_file
+        self.reload_strategy = RELOAD_STRATEGIES[reload](binary, sudo) if reload else None
+        self.reloader = ProxyReloader(self.reload_strategy, config_file) if reload else None
+        self._acl_hash = None
+    
+    @property
+    def target(self):
+        return self.config_file
+    
+    async def sync(self, fleet):
+        epoch, version, networks = fleet.networks()
+        await self.apply_networks(networks)
+        self.epoch, self.version = epoch, version
+    
+    async def apply_networks(self, networks):
+        """Записывает ACL и конфиг узла; при изменении перезагружает 3proxy, если способ задан"""
+        directives = []
+        if self.reload_strategy is not None:
+            directives = self.reload_strategy.directives(self.config_path, self.acl_include_path)
+        try:
+            changed, self._acl_hash = await asyncio.to_thread(
+                write_proxy_config, self.config_file, self.acl_file, self.acl_include_path,
+                directives, networks, self._acl_hash)
+        except Exception:
+            self._acl_hash = None
+            raise
+        if changed and self.reloader is not None:
+            result = await self.reloader.request()
+            if not result['success']:
+                raise RuntimeError(f'Перезагрузка 3proxy не удалась: {result["stderr"]}')
+
+class AgentNode(ProxyNode):
+    """Удаленный узел с агентом: отстающему агенту отправляются только изменения"""
+    
+    kind = 'agent'
+    
+    def __init__(self, name, url, token=None):
+        super().__init__(name)
+        self.url = url.rstrip('/')
+        self.token = token
+    
+    @property
+    def target(self):
+        return self.url
+    
+    def _headers(self):
+        return {'Authorization': f'Bearer {self.token}'} if self.token else {}
+    
+    async def sync(self, fleet):
+        session = fleet.http_session()
+        if self.epoch is None:
+            # Версия агента неизвестна (запуск менеджера или конфликт) - спрашиваем
+            async with session.get(f'{self.url}/status', headers=self._headers()) as response:
+                response.raise_for_status()
+                status = await response.json()
+            self.epoch, self.version = status.get('epoch'), status.get('version')
+        
+        epoch, version = fleet.hub.epoch, fleet.hub.version
+        if self.epoch == epoch and self.version == version:
+            return
+        events = fleet.hub.events_since(self.version) if self.epoch == epoch else None
+        if events is not None:
+            payload = {
+                'epoch': epoch,
+                'base_version': self.version,
+                'version': events[-1]['version'],
+                'events': [{'added': e['added'], 'removed': e['removed']} for e in events]
+            }
+        else:
+            payload = {'epoch': epoch, 'version': version, 'entries': fleet.entries()}
+        async with session.post(f'{self.url}/apply', json=payload, headers=self._headers()) as response:
+            if response.status == 409:
+                # Агент применил не ту версию, что мы думали - в следующей попытке узнаем заново
+                self.epoch = self.version = None
+            response.raise_for_status()
+            status = await response.json()
+        self.epoch, self.version = status['epoch'], status['version']
+
+def load_nodes(path=NODES_FILE):
+    """Читает реестр узлов из nodes.json ({"nodes": [...]})"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        specs = json.load(f).get('nodes', [])
+    nodes = [ProxyNode.from_config(spec) for spec in specs]
+    names = [node.name for node in nodes]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Имена узлов в {path} повторяются')
+    return nodes
+
+class NodeFleet:
+    """Раздача списка разрешенных IP на узлы.
+    
+    У каждого узла своя задача синхронизации: медленный или недоступный узел не задерживает
+    остальные. Одновременно обновляется не больше concurrency узлов.
+    """
+    
+    def __init__(self, nodes, manager, concurrency=NODE_CONCURRENCY, timeout=NODE_TIMEOUT,
+                 retries=NODE_RETRIES, retry_delay=NODE_RETRY_DELAY, resync_interval=NODE_RESYNC_INTERVAL):
+        self.nodes = nodes
+        self.manager = manager
+        self.hub = manager.hub
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.resync_interval = resync_interval
+        self._semaphore = None
+        self._http = None
+        self._resync_task = None
+        # (epoch, version, сети) последнего объединения - общее для всех локальных узлов
+        self._networks = None
+    
+    def http_session(self):
+        if self._http is None or self._http.closed:
+            self._http = ClientSession(timeout=ClientTimeout(total=self.timeout))
+        return self._http
+    
+    def entries(self):
+        return self.manager.fleet_entries()
+    
+    def networks(self):
+        """Объединенные сети текущей версии списка: (epoch, version, сети)"""
+        key = (self.hub.epoch, self.hub.version)
+        if self._networks is None or self._networks[:2] != key:
+            self._networks = key + (self.manager.fleet_networks(),)
+        return self._networks
+    
+    def start(self):
+        if not self.nodes:
+            return
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.hub.listeners.append(self.schedule)
+        self._resync_task = asyncio.ensure_future(self._resync())
+    
+    def schedule(self):
+        """Запускает синхронизацию узлов, у которых она еще не идет"""
+        if self._semaphore is None:
+            return
+        for node in self.nodes:
+            if node.task is None or node.task.done():
+                node.task = asyncio.ensure_future(self._sync(node))
+    
+    async def _resync(self):
+        while True:
+            self.schedule()
+            await asyncio.sleep(self.resync_interval)
+    
+    async def _sync(self, node):
+        """Доводит узел до текущей версии; изменения, пришедшие во время синхронизации, догоняет сразу"""
+        attempt = 0
+        # Об ошибке сообщаем один раз, а не при каждой сверке недоступного узла
+        failing = node.status == 'error'
+        while node.epoch != self.hub.epoch or node.version != self.hub.version:
+            if not failing:
+                node.status = 'syncing'
+            try:
+                async with self._semaphore:
+                    await asyncio.wait_for(node.sync(self), self.timeout)
+            except Exception as e:
+                attempt += 1
+                node.error = str(e) or type(e).__name__
+                if attempt > self.retries:
+                    if not failing:
+                        print(f"Узел {node.name} не обновлен: {node.error}")
+                    node.status = 'error'
+                    return
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+                continue
+            attempt = 0
+            node.error = None
+            node.synced_at = time.time()
+        node.status = 'ok'
+    
+    def status(self):
+        epoch, version = self.hub.epoch, self.hub.version
+        return [node.info(epoch, version) for node in self.nodes]
+    
+    async def close(self):
+        tasks = [node.task for node in self.nodes if node.task is not None]
+        if self._resync_task is not None:
+            tasks.append(self._resync_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+class NodeAgent:
+    """Агент узла: принимает от менеджера полный список или изменения и применяет их к локальному 3proxy"""
+    
+    def __init__(self, node, state_file=NODE_STATE_FILE):
+        self.node = node
+        self.state_file = state_file
+        self.epoch = None
+        self.version = None
+        self.entries = {}
+        self._lock = asyncio.Lock()
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            self.epoch, self.version = state['epoch'], state['version']
+            self.entries = dict.fromkeys(state['entries'])
+    
+    def status(self):
+        return {'epoch': self.epoch, 'version': self.version, 'entries': len(self.entries)}
+    
+    async def apply(self, data):
+        """Применяет обновление; None - если оно не продолжает версию агента (нужен полный список)"""
+        async with self._lock:
+            if 'entries' in data:
+                entries = dict.fromkeys(data['entries'])
+            elif data.get('epoch') == self.epoch and data.get('base_version') == self.version:
+                entries = dict(self.entries)
+                for event in data['events']:
+                    for entry in event['removed']:
+                        entries.pop(entry, None)
+                    for entry in event['added']:
+                        entries[entry] = None
+            else:
+                return None
+            networks = await asyncio.to_thread(lambda: AllowlistIndex(entries).collapse())
+            await self.node.apply_networks(networks)
+            state = {'epoch': data['epoch'], 'version': data['version'], 'entries': list(entries)}
+            await asyncio.to_thread(atomic_write, self.state_file, json.dumps(state))
+            self.epoch, self.version, self.entries = data['epoch'], data['version'], entries
+            return self.status()
+
+class ConfigWriter:
+    """Единственный писатель файлов конфигурации.
+    
+    Изменения ставятся в очередь, применяются по одному к состоянию в памяти,
+    а затем за короткое окно группируются в одну атомарную запись на диск.
+    Вызывающий получает ответ только после того, как его изменение записано.
+    """
+    
+    def __init__(self, prepare, commit, window=COMMIT_WINDOW):
+        self.prepare = prepare
+        self.commit = commit
+        self.window = window
+        self.busy = False
+        # Номер пачки: меняется при начале каждой, чтобы читатели могли заметить запись во время своего чтения
+        self.generation = 0
+        self._queue = None
+        self._task = None
+    
+    async def submit(self, mutation):
+        """Ставит изменение в очередь и ждет его записи на диск.
+        
+        mutation - функция без аргументов, возвращающая (результат, были_ли_изменения).
+        """
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((mutation, future))
+        return await future
+    
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self.window:
+                await asyncio.sleep(self.window)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._commit_batch(batch)
+    
+    async def _commit_batch(self, batch):
+        """Применяет пачку изменений и записывает результат одной фиксацией"""
+        outcomes = []
+        error = None
+        try:
+            await self.prepare()
+            self.busy = True
+            self.generation += 1
+            changed = False
+            for mutation, future in batch:
+                try:
+                    result, mutated = mutation()
+                except Exception as e:
+                    outcomes.append((future, None, e))
+                    continue
+                changed = changed or mutated
+                outcomes.append((future, result, None))
+            if changed:
+                await self.commit()
+        except Exception as e:
+            error = e
+        finally:
+            self.busy = False
+        
+        if error is not None:
+            outcomes = [(future, None, error) for _, future in batch]
+        for future, result, exc in outcomes:
+            if future.done():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+    
+    async def close(self):
+        """Останавливает писателя, отклоняя изменения, которые еще не начали записываться"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError('Писатель конфигурации остановлен'))
+
+class ProxyManager:
+    # Рассылать ли подписчикам изменения хранилища, сделанные в обход сервиса
+    publishes_external_changes = True
+    
+    def __init__(self, ip_resolvers=None, reload_strategy=None, storage=None):
+        self.config_file = CONFIG_FILE
+        self.config_path = PROXY_CONFIG_PATH
+        self.storage = storage or STORAGE_BACKENDS[STORAGE_BACKEND]()
+        self.acl_file = ACL_FILE
+        self.acl_include_path = ACL_INCLUDE_PATH
+        # Хеш содержимого ACL файла: перезаписываем его только при изменении
+        self._acl_hash = None
+        # Список разрешенных IP в памяти: dict (запись -> метаданные) дает и быстрый поиск,
+        # и порядок добавления; перечитывается из хранилища, только если оно изменилось
+        self._allowed_ips = {}
+        self._index = AllowlistIndex()
+        # (epoch, version, сети) последней записи конфига - для локальных узлов без повторного объединения
+        self._networks = None
+        self._loaded = False
+        # Все изменения файлов идут через единственного писателя
+        self._writer = ConfigWriter(prepare=self._load_allowed_ips, commit=self._commit)
+        self.reload_strategy = reload_strategy or RELOAD_STRATEGIES[PROXY_RELOAD_MODE]()
+        self.reloader = ProxyReloader(self.reload_strategy, self.config_file)
+        # Подписчики на изменения и накопленное с последней записи изменение
+        self.hub = AllowlistHub(self.snapshot)
+        self._delta_added = {}
+        self._delta_removed = {}
+        # Записи, у которых изменились только метаданные (продлен срок действия)
+        self._delta_updated = {}
+        # Сроки действия временных записей
+        self.expiry = ExpiryScheduler(self._expire)
+        # Последняя активность клиентов по журналу доступа 3proxy
+        self.access_log = AccessLogTailer()
+        self._access_log_task = None
+        # Дополнительные узлы 3proxy
+        self.fleet = NodeFleet(load_nodes(), self)
+        # Общий пул HTTP соединений и кэш внешнего IP
+        self.ip_resolvers = list(ip_resolvers or IP_RESOLVERS)
+        self._http = None
+        self._current_ip = None
+        self._current_ip_expires = 0
+        self._current_ip_task = None
+        self.ensure_files_exist()
+    
+    def ensure_files_exist(self):
+        """Создает необходимые файлы если их нет"""
+        if not os.path.exists(self.config_file):
+            self.create_default_config()
+    
+    def create_default_config(self):
+        """Создает базовую конфигурацию 3proxy"""
+        default_config = """# 3proxy configuration
+"""
+        with open(self.config_file, 'w') as f:
+            f.write(default_config)
+    
+    def http_session(self):
+        """Возвращает долгоживущую HTTP сессию с пулом соединений"""
+        if self._http is None or self._http.closed:
+            connector = aiohttp.TCPConnector(ttl_dns_cache=CURRENT_IP_TTL)
+            self._http = ClientSession(
+                connector=connector,
+                timeout=ClientTimeout(total=IP_RESOLVE_TIMEOUT)
+            )
+        return self._http
+    
+    async def get_current_ip(self):
+        """Получает текущий внешний IP адрес"""
+        if self._current_ip is not None and time.monotonic() < self._current_ip_expires:
+            return self._current_ip
+        
+        # Одновременные вызовы ждут один и тот же запрос
+        if self._current_ip_task is None or self._current_ip_task.done():
+            self._current_ip_task = asyncio.ensure_future(self._refresh_current_ip())
+        return await asyncio.shield(self._current_ip_task)
+    
+    async def _refresh_current_ip(self):
+        """Определяет внешний IP и кладет результат в кэш"""
+        ip = await self._resolve_current_ip()
+        if ip:
+            ttl = CURRENT_IP_TTL
+        else:
+            ip = "Не удалось определить IP"
+            ttl = CURRENT_IP_FAILURE_TTL
+        self._current_ip = ip
+        self._current_ip_expires = time.monotonic() + ttl
+        return ip
+    
+    async def _resolve_current_ip(self):
+        """Опрашивает все сервисы параллельно и возвращает первый корректный ответ"""
+        session = self.http_session()
+        tasks = [asyncio.ensure_future(self._query_ip_resolver(session, url))
+                 for url in self.ip_resolvers]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    ip = await next_done
+                except Exception:
+                    continue
+                if ip:
+                    return ip
+        finally:
+            for task in tasks:
+                task.cancel()
+        return None
+    
+    async def _query_ip_resolver(self, session, url):
+        """Запрашивает внешний IP у одного сервиса"""
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return None
+                ip = (await response.text()).strip()
+            ipaddress.ip_address(ip)
+            outcome = 'ok'
+            return ip
+        except asyncio.CancelledError:
+            # Другой сервис ответил раньше
+            outcome = 'cancelled'
+            raise
+        finally:
+            IP_RESOLVER_DURATION.observe(time.perf_counter() - start, url, outcome)
+    
+    async def _load_allowed_ips(self):
+        """Перечитывает список из хранилища, только если оно изменилось"""
+        # Пока писатель применяет пачку, память опережает диск - не затираем ее
+        if self._writer.busy:
+            return
+        if self._loaded and not self.storage.changed():
+            return
+        
+        generation = self._writer.generation
+        with ALLOWLIST_STORAGE_DURATION.time('load'):
+            allowed_ips = await asyncio.to_thread(self.storage.load)
+        # Пока шло чтение, писатель применил пачку: прочитанное может ее не содержать, а память уже
+        # содержит - отбрасываем результат, следующее обращение перечитает хранилище заново
+        if self._writer.busy or self._writer.generation != generation:
+            self.storage.invalidate()
+            return
+        
+        # Хранилище изменили в обход сервиса - рассылаем разницу подписчикам
+        previous = self._allowed_ips if self._loaded else None
+        if previous:
+            # Текстовый файл метаданных не хранит - сохраняем известные из памяти
+            for entry, meta in allowed_ips.items():
+                if meta is None:
+                    allowed_ips[entry] = previous.get(entry)
+        self._allowed_ips = allowed_ips
+        self._index = AllowlistIndex(allowed_ips)
+        self.expiry.reset({entry: meta['expires_at'] for entry, meta in allowed_ips.items()
+                           if meta and meta.get('expires_at') is not None})
+        self._loaded = True
+        if previous is not None and self.publishes_external_changes:
+            added = [ip for ip in allowed_ips if ip not in previous]
+            removed = [ip for ip in previous if ip not in allowed_ips]
+            if added or removed:
+                self.hub.publish(added, removed)
+    
+    async def start(self):
+        """Загружает список и запускает удаление истекших записей"""
+        await self._load_allowed_ips()
+        self.expiry.start()
+        self.fleet.start()
+        if self._access_log_task is None or self._access_log_task.done():
+            self._access_log_task = asyncio.ensure_future(self._watch_access_log())
+    
+    async def _watch_access_log(self):
+        """Читает журнал доступа порциями, периодически сохраняет позицию и удаляет неактивные записи"""
+        saved = pruned = time.monotonic()
+        while True:
+            more = False
+            try:
+                batch, more = await asyncio.to_thread(self.access_log.read_batch)
+                self.access_log.merge(batch)
+                now = time.monotonic()
+                if batch and now - saved >= ACCESS_LOG_SAVE_INTERVAL:
+                    await asyncio.to_thread(self.access_log.save_state, self.access_log.state())
+                    saved = now
+                # Пока журнал не дочитан, активность неизвестна - не удаляем
+                if IDLE_PRUNE_DAYS and not more and now - pruned >= IDLE_PRUNE_INTERVAL:
+                    pruned = now
+                    await self.prune_idle(IDLE_PRUNE_DAYS * 86400)
+            except Exception as e:
+                print(f"Ошибка чтения журнала доступа: {e}")
+            if not more:
+                await asyncio.sleep(ACCESS_LOG_POLL_INTERVAL)
+    
+    def entry_activity(self):
+        """Последняя активность по записям списка: dict запись -> (время, число запросов)"""
+        activity = {}
+        for ip, (last_seen, hits) in self.access_log.clients.items():
+            entry = self._index.lookup(ipaddress.ip_address(ip))
+            if entry is None:
+                continue
+            seen, total = activity.get(entry, (0, 0))
+            activity[entry] = (max(seen, last_seen), total + hits)
+        return activity
+    
+    def idle_entries(self, idle_seconds, now=None):
+        """Записи без активности дольше idle_seconds (с момента добавления).
+        
+        Пустой список, если журнал не покрывает окно целиком: без него неактивной выглядела бы любая запись.
+        """
+        now = now or time.time()
+        if not self.access_log.covers(now - idle_seconds):
+            return []
+        activity = self.entry_activity()
+        idle = []
+        for entry, meta in self._allowed_ips.items():
+            added_at = meta.get('added_at') if meta else None
+            seen = max(activity.get(entry, (0, 0))[0], added_at or 0)
+            if now - seen > idle_seconds:
+                idle.append(entry)
+        return idle
+    
+    async def prune_idle(self, idle_seconds):
+        """Удаляет неактивные записи одной пачкой"""
+        await self._load_allowed_ips()
+        if not self.access_log.covers(time.time() - idle_seconds):
+            print("Журнал доступа не покрывает окно неактивности, записи не удаляются")
+            return []
+        idle = self.idle_entries(idle_seconds)
+        if not idle:
+            return []
+        results = await self.remove_allowed_ips(idle)
+        removed = [r['entry'] for r in results if r['status'] == 'removed']
+        print(f"Удалены неактивные записи: {len(removed)}")
+        return removed
+    
+    async def get_activity(self, query=None, limit=None, idle_days=None):
+        """Таблица активности клиентов, недавние первыми.
+        
+        query - сеть CIDR или адрес; с idle_days добавляется список записей без активности дольше idle_days дней.
+        """
+        await self._load_allowed_ips()
+        network = ipaddress.ip_network(query.strip(), strict=False) if query else None
+        rows = []
+        for ip in reversed(self.access_log.clients):
+            address = ipaddress.ip_address(ip)
+            if network is not None and address not in network:
+                continue
+            last_seen, hits = self.access_log.clients[ip]
+            rows.append({'ip': ip, 'entry': self._index.lookup(address),
+                         'last_seen': last_seen, 'hits': hits})
+        rows.sort(key=lambda row: row['last_seen'], reverse=True)
+        activity = {
+            'clients': rows[:limit] if limit else rows,
+            'total': len(rows),
+            'since': self.access_log.since,
+            'idle_prune_days': IDLE_PRUNE_DAYS
+        }
+        if idle_days:
+            activity['idle'] = self.idle_entries(idle_days * 86400)
+        return activity
+    
+    async def add_allowed_ip(self, ip, ttl=None):
+        """Добавляет IP в список разрешенных, ttl - срок действия в секундах"""
+        results = await self.add_allowed_ips([ip], ttl=ttl)
+        return results[0]['status'] in ('added', 'renewed')
+    
+    async def add_allowed_ips(self, ips, added_by=None, comment=None, ttl=None):
+        """Добавляет пачку IP/сетей одной записью файлов, возвращает результат по каждому.
+        
+        С ttl записи временные: удаляются через ttl секунд, повторное добавление продлевает срок.
+        """
+        items = [(ip, _try_normalize_ip_entry(ip)) for ip in ips]
+        now = time.time()
+        meta = {
+            'added_by': added_by,
+            'added_at': now,
+            'comment': comment,
+            'expires_at': now + ttl if ttl else None
+        }
+        return await self._writer.submit(lambda: self._apply_add(items, meta))
+    
+    def _apply_add(self, items, meta):
+        """Применяет добавление к списку в памяти (выполняется писателем)"""
+        results = []
+        added = False
+        for ip, entry in items:
+            if entry is None:
+                result = {'ip': ip, 'status': 'invalid'}
+                # Подсказываем сеть, которую адрес задал бы без проверки битов узла
+                network = _try_normalize_ip_entry(ip, strict=False)
+                if network is not None:
+                    result['network'] = network
+                results.append(result)
+                continue
+            if entry in self._allowed_ips:
+                if self._renew(entry, meta['expires_at']):
+                    results.append({'ip': ip, 'entry': entry, 'status': 'renewed',
+                                    'expires_at': self._allowed_ips[entry]['expires_at']})
+                    added = True
+                else:
+                    results.append({'ip': ip, 'entry': entry, 'status': 'exists'})
+                continue
+            
+            # Адрес внутри уже разрешенной сети не добавляем - он ничего не меняет в ACL,
+            # если только сеть не истекает раньше него
+            network = ipaddress.ip_network(entry)
+            covered_by = next((cover for cover in self._index.coverings(network)
+                               if self._outlives(cover, meta['expires_at'])), None)
+            if covered_by is not None:
+                results.append({'ip': ip, 'entry': entry, 'status': 'covered', 'covered_by': covered_by})
+                continue
+            
+            result = {'ip': ip, 'entry': entry, 'status': 'added'}
+            subsumed = self._index.subsumed(network)
+            if subsumed:
+                result['subsumes'] = subsumed[:SUBSUMED_REPORT_LIMIT]
+                result['subsumes_count'] = len(subsumed)
+            self._allowed_ips[entry] = meta
+            self._index.add(entry, network)
+            self.expiry.schedule(entry, meta['expires_at'])
+            self._record_delta(entry, added=True)
+            added = True
+            results.append(result)
+        return results, added
+    
+    def _outlives(self, entry, expires_at):
+        """Действует ли запись не меньше срока expires_at (None - бессрочно)"""
+        meta = self._allowed_ips.get(entry)
+        current = meta.get('expires_at') if meta else None
+        return current is None or (expires_at is not None and current >= expires_at)
+    
+    def _renew(self, entry, expires_at):
+        """Продлевает временную запись; постоянные записи не становятся временными, сроки не сокращаются"""
+        meta = self._allowed_ips[entry]
+        current = meta.get('expires_at') if meta else None
+        if current is None:
+            return False
+        if expires_at is not None and expires_at <= current:
+            return False
+        meta = {**meta, 'expires_at': expires_at}
+        self._allowed_ips[entry] = meta
+        self.expiry.schedule(entry, expires_at)
+        self._delta_updated[entry] = None
+        return True
+    
+    async def remove_allowed_ips(self, ips):
+        """Удаляет пачку IP/сетей одной записью файлов, возвращает результат по каждому"""
+        items = [(ip, _try_normalize_ip_entry(ip)) for ip in ips]
+        return await self._writer.submit(lambda: self._apply_remove(items))
+    
+    def _apply_remove(self, items):
+        """Применяет удаление к списку в памяти (выполняется писателем)"""
+        results = []
+        removed = False
+        for ip, entry in items:
+            # Записи, добавленные в файл вручную, могут быть не в каноническом виде
+            # (в том числе сети с битами узла)
+            if entry is None and (not isinstance(ip, str) or ip.strip() not in self._allowed_ips):
+                results.append({'ip': ip, 'status': 'invalid'})
+                continue
+            for key in (entry, ip.strip()):
+                if key in self._allowed_ips:
+                    self._discard(key)
+                    removed = True
+                    results.append({'ip': ip, 'entry': key, 'status': 'removed'})
+                    break
+            else:
+                results.append({'ip': ip, 'entry': entry, 'status': 'not_found'})
+        return results, removed
+    
+    async def _expire(self, entries):
+        """Удаляет истекшие записи одной пачкой - одна перегенерация конфига (вызывается планировщиком)"""
+        results = await self._writer.submit(lambda: self._apply_expire(entries, time.time()))
+        if results:
+            print(f"Истек срок действия записей: {len(results)}")
+    
+    def _apply_expire(self, entries, now):
+        """Удаляет записи, срок которых истек и не был продлен, пока планировщик ждал писателя"""
+        expired = []
+        for entry in entries:
+            meta = self._allowed_ips.get(entry)
+            expires_at = meta.get('expires_at') if meta else None
+            if expires_at is not None and expires_at <= now:
+                self._discard(entry)
+                expired.append(entry)
+        return expired, bool(expired)
+    
+    def _discard(self, entry):
+        del self._allowed_ips[entry]
+        self._index.remove(entry)
+        self.expiry.cancel(entry)
+        self._record_delta(entry, added=False)
+    
+    def _record_delta(self, entry, added):
+        """Копит итоговое изменение списка до следующей записи на диск"""
+        undo, record = (self._delta_removed, self._delta_added) if added else (self._delta_added, self._delta_removed)
+        if entry in undo:
+            del undo[entry]
+        else:
+            record[entry] = None
+    
+    async def snapshot(self):
+        """Возвращает версию и полный список разрешенных IP"""
+        await self._load_allowed_ips()
+        return self.hub.version, list(self._allowed_ips)
+    
+    async def current_version(self):
+        """Возвращает версию списка, учитывая изменения файла в обход сервиса"""
+        await self._load_allowed_ips()
+        return self.hub.version
+    
+    async def list_allowed_ips(self, query=None, cursor=None, limit=None):
+        """Страница списка разрешенных IP из сортированного индекса.
+        
+        query - сеть в формате CIDR (записи внутри нее) или начало записи.
+        Возвращает (записи, курсор следующей страницы, общее количество).
+        """
+        await self._load_allowed_ips()
+        network = prefix = None
+        if query:
+            if '/' in query:
+                network = ipaddress.ip_network(query.strip(), strict=False)
+            else:
+                prefix = query.strip()
+        entries, next_cursor = self._index.query(network=network, prefix=prefix, after=cursor, limit=limit)
+        return entries, next_cursor, len(self._allowed_ips)
+    
+    async def get_metadata(self, entries):
+        """Возвращает метаданные записей (кто и когда добавил, комментарий, срок действия)"""
+        await self._load_allowed_ips()
+        return {entry: self._allowed_ips.get(entry) or {} for entry in entries}
+    
+    def fleet_entries(self):
+        """Текущий список для полной отправки на узел"""
+        return list(self._allowed_ips)
+    
+    def fleet_networks(self):
+        """Объединенные сети текущего списка для локальных узлов - из последней записи, если версия та же"""
+        if self._networks is not None and self._networks[:2] == (self.hub.epoch, self.hub.version):
+            return self._networks[2]
+        return self._index.collapse()
+    
+    async def get_nodes(self):
+        """Версии списка на основном конфиге и на каждом узле"""
+        await self._load_allowed_ips()
+        epoch, version = self.hub.epoch, self.hub.version
+        primary = {
+            'name': 'primary',
+            'type': 'local',
+            'target': self.config_file,
+            'version': version,
+            'behind': 0,
+            'status': 'ok',
+            'error': None,
+            'synced_at': None
+        }
+        return {'epoch': epoch, 'version': version, 'nodes': [primary] + self.fleet.status()}
+    
+    async def get_allowed_ips(self):
+        """Получает список разрешенных IP"""
+        await self._load_allowed_ips()
+        return list(self._allowed_ips)
+    
+    async def update_proxy_config(self):
+        """Перегенерирует конфигурацию 3proxy по текущему списку разрешенных IP"""
+        await self._writer.submit(lambda: (None, True))
+    
+    async def _commit(self):
+        """Записывает список IP и конфиг 3proxy на диск (вызывается писателем)"""
+        entries = list(self._allowed_ips) if self.storage.full_rewrite else None
+        # Объединение сетей на большом списке занимает заметное время - считаем его в потоке по копии ключей
+        keys, networks_by_entry = self._index.snapshot()
+        added, removed = list(self._delta_added), list(self._delta_removed)
+        updated = [entry for entry in self._delta_updated if entry in self._allowed_ips]
+        self._delta_added, self._delta_removed, self._delta_updated = {}, {}, {}
+        inserted = {entry: self._allowed_ips[entry] for entry in added + updated}
+        try:
+            if inserted or removed:
+                with ALLOWLIST_STORAGE_DURATION.time('save'):
+                    await asyncio.to_thread(self.storage.save, entries, inserted, removed)
+            networks, config_changed, collapse_seconds, write_seconds = await asyncio.to_thread(
+                self._render_proxy_config, keys, networks_by_entry)
+            ALLOWLIST_COLLAPSE_DURATION.observe(collapse_seconds)
+            PROXY_CONFIG_WRITE_DURATION.observe(write_seconds)
+        except Exception:
+            # Память могла разойтись с диском - при следующем чтении перечитаем хранилище
+            self.storage.invalidate()
+            self._acl_hash = None
+            self.hub.invalidate()
+            raise
+        # Продление меняет только метаданные, но версия (и ETag) должна смениться и от него
+        if added or removed or updated:
+            self.hub.publish(added, removed, updated=updated)
+        self._networks = (self.hub.epoch, self.hub.version, networks)
+        if PROXY_AUTO_RELOAD and config_changed:
+            self.reloader.schedule()
+    
+    def _render_proxy_config(self, keys, networks_by_entry):
+        """Объединяет сети и записывает конфиг (в отдельном потоке): (сети, изменился ли, время объединения и записи)"""
+        start = time.perf_counter()
+        networks = collapse_keys(keys, networks_by_entry)
+        collapsed = time.perf_counter()
+        changed = self._write_proxy_config(networks)
+        return networks, changed, collapsed - start, time.perf_counter() - collapsed
+    
+    def _write_proxy_config(self, networks):
+        """Обновляет ACL файл и основной конфиг 3proxy; True, если они изменились"""
+        directives = self.reload_strategy.directives(self.config_path, self.acl_include_path)
+        changed, self._acl_hash = write_proxy_config(
+            self.config_file, self.acl_file, self.acl_include_path, directives, networks, self._acl_hash)
+        return changed
+    
+    async def close(self):
+        """Останавливает писателя и освобождает сетевые ресурсы менеджера"""
+        await self.expiry.close()
+        await self.fleet.close()
+        if self._access_log_task is not None:
+            self._access_log_task.cancel()
+            try:
+                await self._access_log_task
+            except asyncio.CancelledError:
+                pass
+            self._access_log_task = None
+            await asyncio.to_thread(self.access_log.save_state, self.access_log.state())
+        self.access_log.close()
+        await self._writer.close()
+        self.storage.close()
+        if self._current_ip_task is not None and not self._current_ip_task.done():
+            self._current_ip_task.cancel()
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+    
+    async def restart_proxy(self):
+        """Применяет конфигурацию 3proxy выбранным способом (требует sudo)"""
+        directives = self.reload_strategy.directives(self.config_path, self.acl_include_path)
+        if directives and not await self._config_has(directives):
+            await self.update_proxy_config()
+        return await self.reloader.request()
+    
+    async def _config_has(self, directives):
+        """Проверяет, что все директивы уже есть в конфиге 3proxy"""
+        if not os.path.exists(self.config_file):
+            return False
+        async with aiofiles.open(self.config_file, 'r') as f:
+            present = {line.strip() for line in (await f.read()).splitlines()}
+        return all(d in present for d in directives)
+
+class FollowerProxyManager(ProxyManager):
+    """Менеджер в процессе-последователе.
+    
+    Список читается из общего хранилища, изменения передаются процессу-писателю
+    через unix сокет. Писатель присылает по тому же сокету уведомления об изменениях
+    с номерами своих версий, поэтому подписчики любого процесса видят одни и те же версии.
+    """
+    
+    publishes_external_changes = False
+    
+    def __init__(self, socket_path=WORKER_SOCKET, **kwargs):
+        self.socket_path = socket_path
+        self._writer_http = None
+        self._follow_task = None
+        # Есть ли связь с писателем: пока есть, список меняется только по его уведомлениям
+        self._following = False
+        # Ожидающие, пока уведомления писателя доведут список до версии их записи
+        self._version_waiters = []
+        super().__init__(**kwargs)
+        self.hub.listeners.append(self._wake_version_waiters)
+    
+    def ensure_files_exist(self):
+        # Файлы создает писатель
+        pass
+    
+    async def start(self):
+        await self._load_allowed_ips()
+        if self._follow_task is None or self._follow_task.done():
+            self._follow_task = asyncio.ensure_future(self._follow_writer())
+    
+    async def _load_allowed_ips(self):
+        # Каждая запись писателя меняет хранилище; при связи с ним изменения приходят
+        # уведомлениями, и полностью перечитывать список после каждой записи не нужно
+        if self._loaded and self._following:
+            return
+        await super()._load_allowed_ips()
+    
+    def writer_session(self):
+        """HTTP сессия к процессу-писателю через unix сокет"""
+        if self._writer_http is None or self._writer_http.closed:
+            self._writer_http = ClientSession(connector=aiohttp.UnixConnector(path=self.socket_path))
+        return self._writer_http
+    
+    async def _call_writer(self, path, payload=None, params=None):
+        """Выполняет операцию в процессе-писателе"""
+        try:
+            async with self.writer_session().post(f'http://writer{path}', json=payload, params=params) as response:
+                response.raise_for_status()
+                return await response.json()
+        except aiohttp.ClientError as e:
+            raise RuntimeError(f'Процесс-писатель недоступен: {e}') from e
+    
+    async def _follow_writer(self):
+        """Получает уведомления писателя и обновляет список и версии; переподключается при разрыве"""
+        while True:
+            try:
+                params = {'epoch': self.hub.epoch, 'since': self.hub.version}
+                async with self.writer_session().ws_connect('http://writer/events', params=params) as ws:
+                    epoch = None
+                    async for msg in ws:
+                        if msg.type != WSMsgType.TEXT:
+                            break
+                        event = json.loads(msg.data)
+                        if event['type'] == 'hello':
+                            epoch = event['epoch']
+                            self._following = True
+                        else:
+                            await self._apply_writer_event(event, epoch)
+            except (aiohttp.ClientError, OSError) as e:
+                print(f"Нет связи с процессом-писателем: {e}")
+            finally:
+                self._following = False
+            await asyncio.sleep(WORKER_RECONNECT_DELAY)
+    
+    async def _apply_writer_event(self, event, epoch):
+        if event['type'] == 'allowlist_snapshot':
+            # Писатель перезапущен или история не покрывает пропуск - синхронизируемся заново
+            self.storage.invalidate()
+            await super()._load_allowed_ips()
+            self.hub.follow(epoch, event['version'])
+        elif event['type'] == 'allowlist_delta':
+            # Из хранилища читаем только метаданные добавленных и продленных записей, а не весь список
+            updated = event.get('updated', [])
+            metadata = {}
+            if event['added'] or updated:
+                with ALLOWLIST_STORAGE_DURATION.time('load'):
+                    metadata = await asyncio.to_thread(self.storage.load_metadata, event['added'] + updated)
+            self._apply_delta(event['added'], event['removed'], metadata)
+            for entry in updated:
+                if entry in self._allowed_ips and entry in metadata:
+                    self._allowed_ips[entry] = metadata[entry]
+            self.hub.publish(event['added'], event['removed'], version=event['version'], updated=updated)
+    
+    def _apply_delta(self, added, removed, metadata):
+        """Применяет изменение от писателя к списку и индексу в памяти"""
+        for entry in removed:
+            if entry in self._allowed_ips:
+                del self._allowed_ips[entry]
+                self._index.remove(entry)
+        for entry in added:
+            self._allowed_ips[entry] = metadata.get(entry)
+            network = parse_ip_entry(entry)
+            if network is not None:
+                self._index.add(entry, network)
+    
+    def _wake_version_waiters(self):
+        waiters, self._version_waiters = self._version_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+    
+    async def _wait_for_version(self, reply):
+        """Ждет, пока уведомления писателя доведут список до версии из его ответа.
+        
+        Иначе чтение сразу после своей записи вернуло бы список без нее. Без связи
+        с писателем ждать нечего: следующее чтение перечитает хранилище целиком.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WORKER_SYNC_TIMEOUT
+        while self._following and (self.hub.epoch != reply['epoch'] or self.hub.version < reply['version']):
+            future = loop.create_future()
+            self._version_waiters.append(future)
+            try:
+                await asyncio.wait_for(future, deadline - loop.time())
+            except asyncio.TimeoutError:
+                print(f"Уведомление писателя о версии {reply['version']} не пришло "
+                      f"за {WORKER_SYNC_TIMEOUT} с, текущая версия: {self.hub.version}")
+                return
+    
+    async def add_allowed_ips(self, ips, added_by=None, comment=None, ttl=None):
+        reply = await self._call_writer('/add_ips', {
+            'ips': ips, 'added_by': added_by, 'comment': comment, 'ttl': ttl})
+        await self._wait_for_version(reply)
+        return reply['results']
+    
+    async def remove_allowed_ips(self, ips):
+        reply = await self._call_writer('/remove_ips', {'ips': ips})
+        await self._wait_for_version(reply)
+        return reply['results']
+    
+    async def update_proxy_config(self):
+        await self._wait_for_version(await self._call_writer('/update_proxy_config'))
+    
+    async def restart_proxy(self):
+        return await self._call_writer('/restart_proxy')
+    
+    async def get_nodes(self):
+        return await self._call_writer('/nodes')
+    
+    async def get_activity(self, query=None, limit=None, idle_days=None):
+        params = {key: str(value) for key, value in
+                  (('q', query), ('limit', limit), ('idle_days', idle_days)) if value}
+        return await self._call_writer('/activity', params=params)
+    
+    async def close(self):
+        if self._follow_task is not None:
+            self._follow_task.cancel()
+            self._follow_task = None
+        if self._writer_http is not None:
+            await self._writer_http.close()
+            self._writer_http = None
+        await super().close()
+
+# Инициализируем менеджер прокси
+proxy_manager = FollowerProxyManager() if WORKER_ROLE == 'follower' else ProxyManager()
+
+ALLOWLIST_ENTRIES = GaugeMetric('allowlist_entries', 'Записей в списке разрешенных IP',
+                                function=lambda: len(proxy_manager._allowed_ips))
+ALLOWLIST_VERSION = GaugeMetric('allowlist_version', 'Версия списка разрешенных IP',
+                                function=lambda: proxy_manager.hub.version)
+
+class UserStore:
+    """Пользователи с заранее посчитанными bcrypt хешами паролей"""
+    
+    def __init__(self, path=USERS_FILE, defaults=DEFAULT_USERS):
+        self.path = path
+        self._users = dict(defaults)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._users = {username: password_hash.encode('utf-8')
+                               for username, password_hash in json.load(f).items()}
+    
+    def get_hash(self, username):
+        """Возвращает хеш пароля пользователя или None"""
+        return self._users.get(username)
+
+class RateLimiter:
+    """Ограничение частоты событий по ключу (token bucket)"""
+    
+    def __init__(self, rate, burst, max_keys=AUTH_BUCKETS_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (токены, время обновления), порядок - от давно использованных к недавним
+        self._buckets = OrderedDict()
+    
+    def allow(self, key):
+        """Списывает токен, если он есть; False - попытку надо отклонить"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed
+
+def _timed_checkpw(password, password_hash):
+    """bcrypt.checkpw с замером времени без учета ожидания в очереди пула"""
+    start = time.perf_counter()
+    valid = bcrypt.checkpw(password, password_hash)
+    return valid, time.perf_counter() - start
+
+class Authenticator:
+    """Проверка паролей в отдельном пуле потоков с ограничением частоты попыток"""
+    
+    def __init__(self, users, max_concurrency=AUTH_MAX_CONCURRENCY):
+        self.users = users
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='bcrypt')
+        self._user_limiter = RateLimiter(AUTH_USER_RATE, AUTH_USER_BURST)
+        self._source_limiter = RateLimiter(AUTH_SOURCE_RATE, AUTH_SOURCE_BURST)
+    
+    async def verify(self, username, password, source):
+        """Проверяет учетные данные: возвращает 'ok', 'invalid' или 'throttled'"""
+        result = await self._verify(username, password, source)
+        AUTH_RESULTS.inc(result)
+        return result
+    
+    async def _verify(self, username, password, source):
+        # Лимиты проверяются до хеширования, чтобы перебор не тратил CPU
+        if not self._source_limiter.allow(source):
+            return 'throttled'
+        if not isinstance(username, str) or not isinstance(password, str):
+            return 'invalid'
+        if not self._user_limiter.allow(username):
+            return 'throttled'
+        
+        password_hash = self.users.get_hash(username)
+        if password_hash is None:
+            return 'invalid'
+        loop = asyncio.get_running_loop()
+        valid, seconds = await loop.run_in_executor(
+            self._executor, _timed_checkpw, password.encode('utf-8'), password_hash)
+        result = 'ok' if valid else 'invalid'
+        AUTH_VERIFY_DURATION.observe(seconds, result)
+        return result
+    
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+# Пользователи и проверка паролей (в продакшене используйте базу данных)
+user_store = UserStore()
+authenticator = Authenticator(user_store)
+
+# Сообщения для отказа во входе
+AUTH_ERRORS = {
+    'invalid': 'Неверные учетные данные',
+    'throttled': 'Слишком много попыток входа, попробуйте позже'
+}
+
+def _parse_ip(value):
+    """Разбирает IP адрес из заголовка, None если адрес некорректный"""
+    if not value:
+        return None
+    value = value.strip()
+    # IPv6 может прийти в квадратных скобках, IPv4 - с портом
+    if value.startswith('['):
+        value = value[1:value.find(']')] if ']' in value else value[1:]
+    elif value.count(':') == 1:
+        value = value.split(':', 1)[0]
+    try:
+        return ipaddress.ip_address(value)
+    except ValueError:
+        return None
+
+def _is_trusted_proxy(ip):
+    """Проверяет, входит ли адрес в список доверенных прокси"""
+    return any(ip in net for net in TRUSTED_PROXIES)
+
+def get_client_ip(request):
+    """Определяет IP клиента с учетом цепочки доверенных прокси"""
+    peer = _parse_ip(request.remote)
+    if peer is None:
+        return request.remote
+    if not _is_trusted_proxy(peer):
+        return str(peer)
+    
+    # Идем по X-Forwarded-For справа налево, пропуская доверенные прокси
+    forwarded = []
+    for header in request.headers.getall('X-Forwarded-For', []):
+        forwarded.extend(header.split(','))
+    hops = [ip for ip in map(_parse_ip, forwarded) if ip is not None]
+    for ip in reversed(hops):
+        if not _is_trusted_proxy(ip):
+            return str(ip)
+    if hops:
+        return str(hops[0])
+    
+    real_ip = _parse_ip(request.headers.get('X-Real-IP'))
+    if real_ip is not None:
+        return str(real_ip)
+    return str(peer)
+
+# Внутреннее приложение писателя для процессов-последователей
+worker_runner_key = web.AppKey('worker_runner', web.AppRunner)
+
+async def start_proxy_manager(app):
+    """Запускает фоновые задачи менеджера при старте приложения"""
+    await proxy_manager.start()
+    if WORKER_SOCKET and WORKER_ROLE == 'writer':
+        # Писатель принимает операции последователей на unix сокете
+        runner = web.AppRunner(create_worker_app())
+        await runner.setup()
+        if os.path.exists(WORKER_SOCKET):
+            os.unlink(WORKER_SOCKET)
+        await web.UnixSite(runner, WORKER_SOCKET).start()
+        os.chmod(WORKER_SOCKET, 0o600)
+        app[worker_runner_key] = runner
+
+async def close_proxy_manager(app):
+    """Закрывает сетевые ресурсы менеджера при остановке приложения"""
+    if worker_runner_key in app:
+        await app[worker_runner_key].cleanup()
+        if os.path.exists(WORKER_SOCKET):
+            os.unlink(WORKER_SOCKET)
+    await proxy_manager.close()
+    authenticator.close()
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Считает запросы и время их обработки по маршрутам"""
+    start = time.perf_counter()
+    status = 500
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        # Шаблон маршрута, а не путь: число меток не зависит от запросов
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        HTTP_REQUESTS.inc(request.method, route, status)
+        # Длительность WebSocket - это время жизни соединения, в гистограмму запросов не пишем
+        if not isinstance(response, web.WebSocketResponse):
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, request.method, route)
+
+async def metrics(request):
+    """Метрики в текстовом формате Prometheus"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return web.Response(status=401, text='Требуется авторизация')
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8',
+                        headers={'Cache-Control': 'no-cache'})
+
+def login_required(f):
+    """Декоратор для проверки авторизации"""
+    async def decorated_function(request):
+        session = await get_session(request)
+        if 'user_id' not in session:
+            return web.HTTPFound('/login')
+        return await f(request)
+    return decorated_function
+
+async def index(request):
+    """Главная страница"""
+    session = await get_session(request)
+    current_ip = get_client_ip(request)
+    allowed_ips, next_cursor, total = await proxy_manager.list_allowed_ips(limit=INDEX_PAGE_SIZE)
+    return render_template('index.html', request, {
+        'current_ip': current_ip,
+        'allowed_ips': allowed_ips,
+        'allowed_ips_total': total,
+        'next_cursor': next_cursor,
+        'page_size': INDEX_PAGE_SIZE,
+        'session': session
+    })
+
+async def login(request):
+    """Страница авторизации"""
+    session = await get_session(request)
+    
+    if request.method == 'POST':
+        data = await request.post()
+        username = data.get('username')
+        password = data.get('password')
+        
+        status = await authenticator.verify(username, password, get_client_ip(request))
+        if status == 'ok':
+            session = await new_session(request)
+            session['user_id'] = username
+            return web.HTTPFound('/')
+        else:
+            session = await get_session(request)
+            return render_template('login.html', request, {
+                'error': AUTH_ERRORS[status] + '!',
+                'session': session
+            }, status=429 if status == 'throttled' else 200)
+    
+    return render_template('login.html', request, {'session': session})
+
+async def logout(request):
+    """Выход из системы"""
+    session = await get_session(request)
+    session.invalidate()
+    return web.HTTPFound('/login')
+
+def _add_ip_response(result):
+    """Формирует ответ на добавление одного IP"""
+    ip = result['ip']
+    if result['status'] == 'added':
+        message = f'IP {ip} добавлен в разрешенные'
+        if result.get('subsumes_count'):
+            message += f' (поглощает записей: {result["subsumes_count"]})'
+        return {'success': True, 'message': message, 'result': result}
+    if result['status'] == 'renewed':
+        message = f'Срок действия IP {ip} продлен'
+        return {'success': True, 'message': message, 'result': result}
+    if result['status'] == 'covered':
+        message = f'IP {ip} уже входит в разрешенную сеть {result["covered_by"]}'
+    elif result['status'] == 'invalid' and result.get('network'):
+        message = f'В {ip} указан адрес узла, а не сети; сеть целиком: {result["network"]}'
+    else:
+        message = f'IP {ip} уже в списке или неверный формат'
+    return {'success': False, 'message': message, 'result': result}
+
+async def allow_ip(request):
+    """API для добавления IP в разрешенные"""
+    data = await request.json()
+    ip = data.get('ip')
+    
+    if not ip:
+        return web.json_response({'success': False, 'message': 'IP адрес не указан'})
+    try:
+        ttl = _ttl(data)
+    except ValueError as e:
+        return web.json_response({'success': False, 'message': str(e)})
+    
+    session = await get_session(request)
+    results = await proxy_manager.add_allowed_ips(
+        [ip], added_by=session.get('user_id'), comment=_comment(data), ttl=ttl)
+    return web.json_response(_add_ip_response(results[0]))
+
+def _comment(data):
+    """Достает необязательный комментарий к записи из тела запроса"""
+    comment = data.get('comment')
+    if not isinstance(comment, str) or not comment.strip():
+        return None
+    return comment.strip()[:MAX_COMMENT_LENGTH]
+
+def _ttl(data):
+    """Достает необязательный срок действия записи в секундах, ValueError если формат неверный"""
+    ttl = data.get('ttl')
+    if ttl is None:
+        return None
+    if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or not 0 < ttl <= MAX_TTL:
+        raise ValueError(f'Неверный срок действия: ожидается положительное число секунд, не больше {MAX_TTL}')
+    return ttl
+
+def _batch_ips(data):
+    """Достает список IP из тела пакетного запроса, ValueError если формат неверный"""
+    ips = data.get('ips') if isinstance(data, dict) else None
+    if not isinstance(ips, list) or not ips:
+        raise ValueError('Список IP адресов не указан')
+    if len(ips) > MAX_BATCH_SIZE:
+        raise ValueError(f'Слишком много IP в одном запросе (максимум {MAX_BATCH_SIZE})')
+    return ips
+
+def _batch_response(results, done_status, verb):
+    """Формирует ответ на пакетный запрос с результатом по каждому IP"""
+    done = sum(1 for r in results if r['status'] == done_status)
+    invalid = sum(1 for r in results if r['status'] == 'invalid')
+    return {
+        'success': invalid == 0,
+        'message': f'{verb}: {done} из {len(results)}, неверный формат: {invalid}',
+        'results': results
+    }
+
+async def allow_ips(request):
+    """API для пакетного добавления IP/сетей в разрешенные"""
+    try:
+        data = await request.json()
+        ips = _batch_ips(data)
+        ttl = _ttl(data)
+    except ValueError as e:
+        return web.json_response({'success': False, 'message': str(e)})
+    
+    session = await get_session(request)
+    results = await proxy_manager.add_allowed_ips(
+        ips, added_by=session.get('user_id'), comment=_comment(data), ttl=ttl)
+    return web.json_response(_batch_response(results, 'added', 'Добавлено'))
+
+async def remove_ips(request):
+    """API для пакетного удаления IP/сетей из разрешенных"""
+    try:
+        ips = _batch_ips(await request.json())
+    except ValueError as e:
+        return web.json_response({'success': False, 'message': str(e)})
+    
+    results = await proxy_manager.remove_allowed_ips(ips)
+    return web.json_response(_batch_response(results, 'removed', 'Удалено'))
+
+async def api_current_ip(request):
+    """API для получения текущего IP"""
+    current_ip = get_client_ip(request)
+    return web.json_response({'ip': current_ip})
+
+async def api_server_ip(request):
+    """API для получения внешнего IP самого сервера"""
+    server_ip = await proxy_manager.get_current_ip()
+    return web.json_response({'ip': server_ip})
+
+async def api_allowed_ips(request):
+    """API для получения списка разрешенных IP.
+    
+    Параметры: limit и cursor - постраничный вывод, q - сеть CIDR или начало адреса,
+    details=1 - добавить метаданные записей (кто и когда добавил, комментарий, срок действия).
+    Ответ помечается ETag по версии списка, на If-None-Match отвечаем 304.
+    """
+    version = await proxy_manager.current_version()
+    etag = f'W/"{proxy_manager.hub.epoch}-{version}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if_none_match = request.headers.get('If-None-Match', '')
+    if etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return web.Response(status=304, headers=headers)
+    
+    query = request.query.get('q')
+    cursor = request.query.get('cursor')
+    limit = request.query.get('limit')
+    if not (query or cursor or limit):
+        # Без параметров - весь список в порядке добавления, как раньше
+        allowed_ips = await proxy_manager.get_allowed_ips()
+        next_cursor = None
+        total = len(allowed_ips)
+    else:
+        try:
+            limit = min(max(int(limit), 1), MAX_PAGE_SIZE) if limit else MAX_PAGE_SIZE
+            allowed_ips, next_cursor, total = await proxy_manager.list_allowed_ips(query, cursor, limit)
+        except ValueError as e:
+            return web.json_response({'success': False, 'message': str(e)}, status=400)
+    
+    response = {
+        'ips': allowed_ips,
+        'total': total,
+        'version': version,
+        'next_cursor': next_cursor
+    }
+    if request.query.get('details'):
+        response['details'] = await proxy_manager.get_metadata(allowed_ips)
+    return web.json_response(response, headers=headers)
+
+async def api_activity(request):
+    """API для получения последней активности клиентов по журналу доступа 3proxy.
+    
+    Параметры: q - сеть CIDR или адрес, limit - количество строк,
+    idle_days - добавить список записей без активности дольше указанного числа дней.
+    """
+    try:
+        limit = min(max(int(request.query.get('limit', MAX_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        idle_days = max(float(request.query.get('idle_days', IDLE_PRUNE_DAYS)), 0)
+        activity = await proxy_manager.get_activity(request.query.get('q'), limit, idle_days)
+    except ValueError as e:
+        return web.json_response({'success': False, 'message': str(e)}, status=400)
+    return web.json_response(activity)
+
+async def api_nodes(request):
+    """API для получения версии списка на каждом узле 3proxy"""
+    return web.json_response(await proxy_manager.get_nodes())
+
+def _restart_response(result):
+    """Формирует ответ на перезапуск прокси"""
+    if result['success']:
+        message = 'Конфигурация прокси сервера применена' if result['mode'] != 'restart' else 'Прокси сервер перезапущен'
+    else:
+        message = 'Ошибка при перезапуске прокси сервера'
+        if result['stderr']:
+            message += f': {result["stderr"]}'
+    return {
+        'success': result['success'],
+        'message': message,
+        'mode': result['mode'],
+        'returncode': result['returncode'],
+        'stderr': result['stderr']
+    }
+
+async def restart_proxy(request):
+    """Перезапуск прокси сервера"""
+    result = await proxy_manager.restart_proxy()
+    return web.json_response(_restart_response(result))
+
+# Обработчики сообщений WebSocket: тип -> (функция, нужна ли авторизация, режим)
+WS_HANDLERS = {}
+
+def ws_handler(msg_type, auth=True, mode='concurrent'):
+    """Регистрирует обработчик сообщения WebSocket.
+    
+    Режимы: 'inline' - выполняется до чтения следующего сообщения (авторизация, подписка),
+    'ordered' - изменения, выполняются строго по порядку поступления,
+    'concurrent' - выполняются параллельно с остальными.
+    """
+    def decorator(f):
+        WS_HANDLERS[msg_type] = (f, auth, mode)
+        return f
+    return decorator
+
+class WSConnection:
+    """Состояние одного WebSocket соединения и диспетчер его сообщений"""
+    
+    def __init__(self, request, ws, max_concurrency=WS_MAX_CONCURRENCY):
+        self.request = request
+        self.ws = ws
+        self.user = None
+        self.subscription = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        # asyncio.Lock отдает захват в порядке очереди - изменения выполняются по порядку
+        self._ordered = asyncio.Lock()
+        self._tasks = set()
+    
+    async def send(self, payload):
+        await self.ws.send_json(payload)
+    
+    async def dispatch(self, data):
+        """Проверяет авторизацию и запускает обработчик сообщения"""
+        msg_type = data.get('type')
+        # Тип может быть любым JSON значением, в том числе нехешируемым (список, объект)
+        known = isinstance(msg_type, str) and msg_type in WS_HANDLERS
+        # Неизвестные типы считаем вместе, чтобы клиент не раздувал число меток
+        WS_MESSAGES.inc(msg_type if known else 'unknown')
+        if not known:
+            await self._reply(data, {
+                'type': 'error',
+                'message': f'Неизвестный тип сообщения: {msg_type}'
+            })
+            return
+        
+        handler, auth, mode = WS_HANDLERS[msg_type]
+        if auth and self.user is None:
+            await self._reply(data, {
+                'type': 'error',
+                'message': 'Требуется авторизация'
+            })
+            return
+        
+        if mode == 'inline':
+            await self._execute(handler, data, ordered=False)
+            return
+        
+        # Не читаем новые сообщения, пока заняты все слоты соединения
+        await self._slots.acquire()
+        task = asyncio.ensure_future(self._execute(handler, data, ordered=mode == 'ordered'))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+    
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._slots.release()
+    
+    async def _execute(self, handler, data, ordered):
+        try:
+            with WS_MESSAGE_DURATION.time(data['type']):
+                if ordered:
+                    async with self._ordered:
+                        response = await handler(self, data)
+                else:
+                    response = await handler(self, data)
+        except Exception as e:
+            response = {
+                'type': 'error',
+                'message': f'Ошибка обработки запроса: {str(e)}'
+            }
+        await self._reply(data, response)
+    
+    async def _reply(self, data, response):
+        """Отправляет ответ, повторяя id запроса клиента"""
+        if 'id' in data:
+            response['id'] = data['id']
+        try:
+            await self.send(response)
+        except ConnectionError:
+            pass
+    
+    async def close(self):
+        """Отменяет незавершенные обработчики и снимает подписку"""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.subscription is not None:
+            proxy_manager.hub.unsubscribe(self.subscription)
+            self.subscription = None
+
+@ws_handler('auth', auth=False, mode='inline')
+async def ws_auth(conn, data):
+    """Авторизация соединения"""
+    username = data.get('username')
+    password = data.get('password')
+    
+    status = await authenticator.verify(username, password, get_client_ip(conn.request))
+    if status != 'ok':
+        return {
+            'type': 'auth_response',
+            'success': False,
+            'message': AUTH_ERRORS[status]
+        }
+    
+    conn.user = username
+    return {
+        'type': 'auth_response',
+        'success': True,
+        'message': 'Авторизация успешна',
+        'user': username
+    }
+
+@ws_handler('get_current_ip')
+async def ws_get_current_ip(conn, data):
+    """Получение текущего IP"""
+    return {
+        'type': 'current_ip_response',
+        'success': True,
+        'ip': get_client_ip(conn.request)
+    }
+
+@ws_handler('add_ip', mode='ordered')
+async def ws_add_ip(conn, data):
+    """Добавление IP в разрешенные"""
+    ip = data.get('ip')
+    if not ip:
+        return {
+            'type': 'add_ip_response',
+            'success': False,
+            'message': 'IP адрес не указан'
+        }
+    try:
+        ttl = _ttl(data)
+    except ValueError as e:
+        return {'type': 'add_ip_response', 'success': False, 'message': str(e)}
+    
+    results = await proxy_manager.add_allowed_ips(
+        [ip], added_by=conn.user, comment=_comment(data), ttl=ttl)
+    return {'type': 'add_ip_response', **_add_ip_response(results[0])}
+
+@ws_handler('add_ips', mode='ordered')
+async def ws_add_ips(conn, data):
+    """Пакетное добавление IP"""
+    try:
+        ips = _batch_ips(data)
+        ttl = _ttl(data)
+    except ValueError as e:
+        return {'type': 'add_ips_response', 'success': False, 'message': str(e)}
+    
+    results = await proxy_manager.add_allowed_ips(
+        ips, added_by=conn.user, comment=_comment(data), ttl=ttl)
+    return {'type': 'add_ips_response', **_batch_response(results, 'added', 'Добавлено')}
+
+@ws_handler('remove_ips', mode='ordered')
+async def ws_remove_ips(conn, data):
+    """Пакетное удаление IP"""
+    try:
+        ips = _batch_ips(data)
+    except ValueError as e:
+        return {'type': 'remove_ips_response', 'success': False, 'message': str(e)}
+    
+    results = await proxy_manager.remove_allowed_ips(ips)
+    return {'type': 'remove_ips_response', **_batch_response(results, 'removed', 'Удалено')}
+
+@ws_handler('get_allowed_ips')
+async def ws_get_allowed_ips(conn, data):
+    """Получение списка разрешенных IP"""
+    allowed_ips = await proxy_manager.get_allowed_ips()
+    return {
+        'type': 'allowed_ips_response',
+        'success': True,
+        'ips': allowed_ips
+    }
+
+@ws_handler('subscribe', mode='inline')
+async def ws_subscribe(conn, data):
+    """Подписка на изменения списка разрешенных IP"""
+    if conn.subscription is not None:
+        proxy_manager.hub.unsubscribe(conn.subscription)
+    await proxy_manager.snapshot()
+    # Версии сравнимы только в пределах эпохи: после перезапуска клиент получит снимок
+    conn.subscription = proxy_manager.hub.subscribe(conn.send, since=data.get('since'), epoch=data.get('epoch'))
+    return {
+        'type': 'subscribe_response',
+        'success': True,
+        'epoch': proxy_manager.hub.epoch,
+        'version': proxy_manager.hub.version
+    }
+
+@ws_handler('unsubscribe', mode='inline')
+async def ws_unsubscribe(conn, data):
+    """Отмена подписки на изменения"""
+    if conn.subscription is not None:
+        proxy_manager.hub.unsubscribe(conn.subscription)
+        conn.subscription = None
+    return {
+        'type': 'unsubscribe_response',
+        'success': True
+    }
+
+@ws_handler('restart_proxy', mode='ordered')
+async def ws_restart_proxy(conn, data):
+    """Перезапуск прокси (после ранее отправленных изменений списка)"""
+    result = await proxy_manager.restart_proxy()
+    return {'type': 'restart_proxy_response', **_restart_response(result)}
+
+async def websocket_handler(request):
+    """WebSocket обработчик для авторизации и управления IP"""
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    conn = WSConnection(request, ws)
+    WS_CONNECTIONS.inc()
+    
+    try:
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT:
+                try:
+                    data = json.loads(msg.data)
+                except json.JSONDecodeError:
+                    await ws.send_json({
+                        'type': 'error',
+                        'message': 'Неверный формат JSON'
+                    })
+                    continue
+                if not isinstance(data, dict):
+                    await ws.send_json({
+                        'type': 'error',
+                        'message': 'Ожидался JSON объект'
+                    })
+                    continue
+                await conn.dispatch(data)
+            
+            elif msg.type == WSMsgType.ERROR:
+                print(f'WebSocket соединение закрыто с ошибкой: {ws.exception()}')
+    
+    finally:
+        WS_CONNECTIONS.dec()
+        await conn.close()
+        print(f'WebSocket соединение закрыто для пользователя: {conn.user or "неавторизованный"}')
+    
+    return ws
+
+def _worker_write_response(results):
+    """Ответ на запись: результаты и версия списка после нее - последователь дождется ее уведомления"""
+    return {'results': results, 'epoch': proxy_manager.hub.epoch, 'version': proxy_manager.hub.version}
+
+async def worker_add_ips(request):
+    """Добавление IP по запросу последователя"""
+    data = await request.json()
+    results = await proxy_manager.add_allowed_ips(
+        data['ips'], added_by=data.get('added_by'), comment=data.get('comment'), ttl=data.get('ttl'))
+    return web.json_response(_worker_write_response(results))
+
+async def worker_remove_ips(request):
+    """Удаление IP по запросу последователя"""
+    data = await request.json()
+    return web.json_response(_worker_write_response(await proxy_manager.remove_allowed_ips(data['ips'])))
+
+async def worker_update_proxy_config(request):
+    await proxy_manager.update_proxy_config()
+    return web.json_response(_worker_write_response(None))
+
+async def worker_restart_proxy(request):
+    return web.json_response(await proxy_manager.restart_proxy())
+
+async def worker_activity(request):
+    query = request.query
+    activity = await proxy_manager.get_activity(
+        query.get('q'), int(query.get('limit', MAX_PAGE_SIZE)), float(query.get('idle_days', 0)))
+    return web.json_response(activity)
+
+async def worker_nodes(request):
+    return web.json_response(await proxy_manager.get_nodes())
+
+async def worker_events(request):
+    """Поток изменений списка для последователя: с версии since, если эпоха совпадает, иначе со снимка"""
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    hub = proxy_manager.hub
+    since = request.query.get('since')
+    await ws.send_json({'type': 'hello', 'epoch': hub.epoch})
+    subscription = hub.subscribe(ws.send_json, int(since) if since is not None else None,
+                                 request.query.get('epoch'))
+    try:
+        async for msg in ws:
+            pass
+    finally:
+        hub.unsubscribe(subscription)
+    return ws
+
+def create_worker_app():
+    """Внутреннее приложение писателя для процессов-последователей (только unix сокет, без авторизации)"""
+    app = web.Application()
+    app.router.add_post('/add_ips', worker_add_ips)
+    app.router.add_post('/remove_ips', worker_remove_ips)
+    app.router.add_post('/update_proxy_config', worker_update_proxy_config)
+    app.router.add_post('/restart_proxy', worker_restart_proxy)
+    app.router.add_post('/activity', worker_activity)
+    app.router.add_post('/nodes', worker_nodes)
+    app.router.add_get('/events', worker_events)
+    return app
+
+def create_agent_app(agent, token=NODE_AGENT_TOKEN):
+    """Приложение агента узла: GET /status и POST /apply с авторизацией по токену"""
+    
+    def authorized(request):
+        # Без токена агент не принимает ничего, иначе подошел бы заголовок 'Bearer None'
+        return bool(token) and request.headers.get('Authorization') == f'Bearer {token}'
+    
+    async def status(request):
+        if not authorized(request):
+            return web.json_response({'success': False, 'message': 'Требуется авторизация'}, status=401)
+        return web.json_response(agent.status())
+    
+    async def apply(request):
+        if not authorized(request):
+            return web.json_response({'success': False, 'message': 'Требуется авторизация'}, status=401)
+        result = await agent.apply(await request.json())
+        if result is None:
+            return web.json_response({'success': False, 'message': 'Версия не совпадает, нужен полный список',
+                                      **agent.status()}, status=409)
+        return web.json_response(result)
+    
+    app = web.Application()
+    app.router.add_get('/status', status)
+    app.router.add_post('/apply', apply)
+    return app
+
+def create_app():
+    """Создает и настраивает приложение"""
+    app = web.Application(middlewares=[metrics_middleware])
+    
+    # Настройка сессий
+    # Используем SimpleCookieStorage (без шифрования)
+    # Для продакшена рекомендуется использовать Redis или другое хранилище сессий с шифрованием
+    setup(app, SimpleCookieStorage())
+    
+    # Настройка CORS
+    cors = cors_setup(app, defaults={
+        "*": ResourceOptions(
+            allow_credentials=True,
+            expose_headers="*",
+            allow_headers="*",
+            allow_methods="*"
+        )
+    })
+    
+    # Настройка шаблонов
+    import os
+    template_path = os.path.join(os.path.dirname(__file__), 'templates')
+    jinja_setup(app, loader=jinja2.FileSystemLoader(template_path))
+    
+    # Удаление истекших записей и чтение журнала доступа работают, пока работает приложение;
+    # общая HTTP сессия закрывается вместе с приложением
+    app.on_startup.append(start_proxy_manager)
+    app.on_cleanup.append(close_proxy_manager)
+    
+    # Маршруты
+    app.router.add_get('/', login_required(index))
+    app.router.add_get('/login', login)
+    app.router.add_post('/login', login)
+    app.router.add_get('/logout', logout)
+    app.router.add_post('/allow_ip', login_required(allow_ip))
+    app.router.add_post('/allow_ips', login_required(allow_ips))
+    app.router.add_post('/remove_ips', login_required(remove_ips))
+    app.router.add_get('/api/current_ip', login_required(api_current_ip))
+    app.router.add_get('/api/server_ip', login_required(api_server_ip))
+    app.router.add_get('/api/allowed_ips', login_required(api_allowed_ips))
+    app.router.add_get('/api/activity', login_required(api_activity))
+    app.router.add_get('/api/nodes', login_required(api_nodes))
+    app.router.add_get('/metrics', metrics)
+    app.router.add_post('/restart_proxy', login_required(restart_proxy))
+    
+    # WebSocket маршрут
+    app.router.add_get('/ws', websocket_handler)
+    
+    # Настройка CORS для всех маршрутов (кроме статических)
+    for route in list(app.router.routes()):
+        if not isinstance(route.resource, web.StaticResource):
+            try:
+                cors.add(route)
+            except ValueError:
+                # Пропускаем маршруты, которые уже имеют CORS
+                pass
+    
+    return app
+
+if __name__ == '__main__':
+    app = create_app()
+    web.run_app(app, host='0.0.0.0', port=5000)
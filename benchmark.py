@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест сервиса управления 3proxy
+
+Запускает create_app() во временном каталоге с заглушками: локальный сервис внешнего IP
+(IP_RESOLVERS), поддельные 3proxy и sudo (PROXY_BINARY, PROXY_SUDO) - реальные команды
+не выполняются. Для каждого размера списка разрешенных IP (по умолчанию от 10 до 100000)
+гоняет вход, /allow_ip, /api/allowed_ips и сообщения /ws с заданной параллельностью и
+записывает пропускную способность и задержки p50/p95/p99 в JSON для сравнения между коммитами.
+
+Пример: python benchmark.py --sizes 10,1000,100000 --concurrency 1,16 --output before.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import stat
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import ipaddress
+import importlib
+import subprocess
+from datetime import datetime, timezone
+from aiohttp import web, ClientSession, CookieJar, DummyCookieJar, TCPConnector
+
+# Размеры списка разрешенных IP, по которым идет прогон
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+DEFAULT_CONCURRENCY = [16]
+# Запросов на один сценарий при одном размере списка
+DEFAULT_REQUESTS = 200
+# Вход дорогой (bcrypt), поэтому запросов меньше
+DEFAULT_LOGIN_REQUESTS = 20
+DEFAULT_OUTPUT = 'benchmark_results.json'
+SCENARIOS = ['login', 'allow_ip', 'allowed_ips', 'allowed_ips_page',
+             'ws_get_current_ip', 'ws_add_ip', 'ws_get_allowed_ips']
+
+USERNAME = 'admin'
+PASSWORD = 'admin123'
+# Ответ заглушки сервиса внешнего IP
+STUB_EXTERNAL_IP = '203.0.113.10'
+# Записи для предзагрузки и для сценариев добавления берутся из разных сетей через адрес,
+# чтобы соседние адреса не склеивались в одну сеть при записи конфига
+PRELOAD_NETWORK = ipaddress.ip_network('10.0.0.0/8')
+ADD_NETWORK = ipaddress.ip_network('100.64.0.0/10')
+ADDRESS_STRIDE = 2
+PAGE_LIMIT = 100
+PERCENTILES = (50, 95, 99)
+
+def address(network, index):
+    """index-й адрес сети с шагом ADDRESS_STRIDE"""
+    return str(network.network_address + 1 + index * ADDRESS_STRIDE)
+
+def percentile(sorted_values, p):
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+def summarize(latencies, errors, elapsed):
+    """Сводка по сценарию: пропускная способность и задержки в миллисекундах"""
+    latencies.sort()
+    count = len(latencies)
+    summary = {
+        'requests': count,
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'throughput_rps': round(count / elapsed, 2) if elapsed > 0 else None,
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else None,
+        'max_ms': round(latencies[-1] * 1000, 3) if count else None,
+    }
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary[f'p{p}_ms'] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+async def run_load(requests, concurrency, request):
+    """Выполняет requests вызовов request(i) в concurrency потоках; request возвращает успех"""
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def worker(slot):
+        nonlocal next_index, errors
+        while next_index < requests:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            try:
+                ok = await request(index, slot)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(slot) for slot in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+def write_fake_binaries(directory):
+    """Создает поддельные 3proxy и sudo; sudo только записывает команду и ничего не запускает"""
+    commands_log = os.path.join(directory, 'commands.log')
+    scripts = {
+        '3proxy': '#!/bin/sh\nexit 0\n',
+        'sudo': f'#!/bin/sh\necho "$@" >> "{commands_log}"\nexit 0\n',
+    }
+    paths = {}
+    for name, body in scripts.items():
+        path = os.path.join(directory, 'bin', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        paths[name] = path
+    return paths, commands_log
+
+async def start_ip_stub():
+    """Запускает заглушку сервиса внешнего IP, возвращает (runner, url)"""
+    async def handler(request):
+        return web.Response(text=STUB_EXTERNAL_IP)
+
+    stub = web.Application()
+    stub.router.add_get('/', handler)
+    runner = web.AppRunner(stub, access_log=None)
+    await runner.setup()
+    site = web.SockSite(runner, bound_socket())
+    await site.start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}/'
+
+def bound_socket():
+    """Сокет на свободном локальном порту"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+def git_commit():
+    """Коммит, на котором запущен тест, если это git репозиторий"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Benchmark:
+    """Прогон сценариев против запущенного приложения"""
+
+    def __init__(self, base_url, args):
+        self.base_url = base_url
+        self.ws_url = base_url.replace('http://', 'ws://') + '/ws'
+        self.args = args
+        self.session = None
+        self.login_session = None
+        self.sockets = []
+        self.preloaded = 0
+        self.added = 0
+        self.pending = []
+
+    async def start(self, ws_connections):
+        connector = TCPConnector(limit=0)
+        # Куки сессии выдаются для 127.0.0.1, без unsafe aiohttp их не сохраняет
+        self.session = ClientSession(connector=connector, cookie_jar=CookieJar(unsafe=True))
+        self.login_session = ClientSession(connector=TCPConnector(limit=0), cookie_jar=DummyCookieJar())
+        if not await self.login(self.session):
+            raise RuntimeError('Не удалось войти в сервис')
+        if any(name.startswith('ws_') for name in self.args.scenarios):
+            self.sockets = await asyncio.gather(*(self.open_ws() for _ in range(ws_connections)))
+
+    async def close(self):
+        for ws in self.sockets:
+            await ws.close()
+        await self.session.close()
+        await self.login_session.close()
+
+    async def login(self, session):
+        async with session.post(f'{self.base_url}/login', allow_redirects=False,
+                                data={'username': USERNAME, 'password': PASSWORD}) as response:
+            await response.read()
+            return response.status == 302
+
+    async def open_ws(self):
+        ws = await self.session.ws_connect(self.ws_url, max_msg_size=0)
+        await ws.send_json({'type': 'auth', 'username': USERNAME, 'password': PASSWORD})
+        response = await ws.receive_json()
+        if not response.get('success'):
+            raise RuntimeError(f'Не удалось авторизоваться по WebSocket: {response.get("message")}')
+        return ws
+
+    async def preload(self, size, batch_size):
+        """Догружает список до size записей пакетами через /allow_ips"""
+        start = time.perf_counter()
+        while self.preloaded < size:
+            count = min(batch_size, size - self.preloaded)
+            ips = [address(PRELOAD_NETWORK, self.preloaded + i) for i in range(count)]
+            async with self.session.post(f'{self.base_url}/allow_ips', json={'ips': ips}) as response:
+                data = await response.json()
+            if not data.get('success'):
+                raise RuntimeError(f'Предзагрузка не удалась: {data.get("message")}')
+            self.preloaded += count
+        return time.perf_counter() - start
+
+    async def entries(self):
+        async with self.session.get(f'{self.base_url}/api/allowed_ips', params={'limit': 1}) as response:
+            return (await response.json())['total']
+
+    def next_address(self):
+        ip = address(ADD_NETWORK, self.added)
+        self.added += 1
+        self.pending.append(ip)
+        return ip
+
+    async def cleanup(self, batch_size):
+        """Удаляет добавленные сценариями записи, чтобы размер списка не рос между шагами"""
+        while self.pending:
+            ips, self.pending = self.pending[:batch_size], self.pending[batch_size:]
+            async with self.session.post(f'{self.base_url}/remove_ips', json={'ips': ips}) as response:
+                await response.read()
+
+    async def request_json(self, method, path, **kwargs):
+        async with self.session.request(method, f'{self.base_url}{path}', **kwargs) as response:
+            data = await response.json()
+            return response.status, data
+
+    async def ws_call(self, slot, message):
+        ws = self.sockets[slot]
+        await ws.send_json(message)
+        return await ws.receive_json()
+
+    def scenario(self, name):
+        """Функция одного запроса сценария: (index, slot) -> успех"""
+        if name == 'login':
+            return lambda index, slot: self.login(self.login_session)
+        if name == 'allow_ip':
+            async def allow_ip(index, slot):
+                status, data = await self.request_json('POST', '/allow_ip', json={'ip': self.next_address()})
+                return status == 200 and data.get('success')
+            return allow_ip
+        if name in ('allowed_ips', 'allowed_ips_page'):
+            params = {'limit': PAGE_LIMIT} if name == 'allowed_ips_page' else {}
+            async def allowed_ips(index, slot):
+                status, data = await self.request_json('GET', '/api/allowed_ips', params=params)
+                return status == 200 and 'ips' in data
+            return allowed_ips
+        if name == 'ws_get_current_ip':
+            async def ws_get_current_ip(index, slot):
+                return (await self.ws_call(slot, {'type': 'get_current_ip'})).get('success')
+            return ws_get_current_ip
+        if name == 'ws_add_ip':
+            async def ws_add_ip(index, slot):
+                return (await self.ws_call(slot, {'type': 'add_ip', 'ip': self.next_address()})).get('success')
+            return ws_add_ip
+        if name == 'ws_get_allowed_ips':
+            async def ws_get_allowed_ips(index, slot):
+                return (await self.ws_call(slot, {'type': 'get_allowed_ips'})).get('success')
+            return ws_get_allowed_ips
+        raise ValueError(f'Неизвестный сценарий: {name}')
+
+    async def run(self, sizes, concurrency_levels, batch_size):
+        results = []
+        for size in sizes:
+            bulk_load = await self.preload(size, batch_size)
+            for concurrency in concurrency_levels:
+                step = {
+                    'size': size,
+                    'concurrency': concurrency,
+                    'entries': await self.entries(),
+                    'bulk_load_seconds': round(bulk_load, 4),
+                    'scenarios': {}
+                }
+                print(f"📋 Размер списка {size}, параллельность {concurrency}")
+                for name in self.args.scenarios:
+                    requests = self.args.login_requests if name == 'login' else self.args.requests
+                    summary = await run_load(requests, concurrency, self.scenario(name))
+                    step['scenarios'][name] = summary
+                    await self.cleanup(batch_size)
+                    print(f"   {name:20} {summary['throughput_rps'] or 0:10.1f} rps"
+                          f"  p50 {summary['p50_ms'] or 0:9.2f} ms"
+                          f"  p95 {summary['p95_ms'] or 0:9.2f} ms"
+                          f"  p99 {summary['p99_ms'] or 0:9.2f} ms"
+                          f"  ошибок {summary['errors']}")
+                # Предзагрузка выполняется один раз на размер
+                bulk_load = 0
+                results.append(step)
+        return results
+
+async def main(args):
+    output = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix='3proxy-bench-')
+    binaries, commands_log = write_fake_binaries(workdir)
+    stub_runner, stub_url = await start_ip_stub()
+
+    # Глобальные объекты app создаются при импорте и читают окружение и относительные пути,
+    # поэтому окружение и рабочий каталог настраиваются до импорта
+    os.environ.update({
+        'IP_RESOLVERS': stub_url,
+        'PROXY_BINARY': binaries['3proxy'],
+        'PROXY_SUDO': binaries['sudo'],
+        'PROXY_AUTO_RELOAD': '1' if args.auto_reload else '',
+        'STORAGE_BACKEND': args.storage,
+        'WORKER_ROLE': 'writer',
+    })
+    for name in ('WORKER_SOCKET', 'METRICS_TOKEN', 'USERS_FILE', 'ALLOWLIST_DB', 'ACL_INCLUDE_PATH',
+                 'ACCESS_LOG_FILE', 'ACCESS_LOG_STATE', 'NODES_FILE', 'NODE_STATE_FILE', 'IDLE_PRUNE_DAYS'):
+        os.environ.pop(name, None)
+    os.chdir(workdir)
+    os.makedirs('config', exist_ok=True)
+    os.makedirs('logs', exist_ok=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    app_module = importlib.import_module('app')
+
+    if not args.throttle:
+        # Ограничение попыток входа отвечает на перебор, а не на нагрузку - снимаем его,
+        # чтобы измерять стоимость bcrypt, а не отказы
+        app_module.AUTH_USER_RATE = app_module.AUTH_SOURCE_RATE = math.inf
+        app_module.AUTH_USER_BURST = app_module.AUTH_SOURCE_BURST = math.inf
+        app_module.authenticator = app_module.Authenticator(app_module.user_store)
+
+    runner = web.AppRunner(app_module.create_app(), access_log=None)
+    await runner.setup()
+    site = web.SockSite(runner, bound_socket())
+    await site.start()
+    base_url = f'http://127.0.0.1:{runner.addresses[0][1]}'
+    print(f"🚀 Сервис запущен на {base_url}, каталог {workdir}")
+
+    benchmark = Benchmark(base_url, args)
+    try:
+        await benchmark.start(max(args.concurrency))
+        results = await benchmark.run(sorted(args.sizes), args.concurrency, app_module.MAX_BATCH_SIZE)
+    finally:
+        await benchmark.close()
+        await runner.cleanup()
+        await stub_runner.cleanup()
+
+    commands = 0
+    if os.path.exists(commands_log):
+        with open(commands_log) as f:
+            commands = sum(1 for _ in f)
+    report = {
+        'commit': git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {
+            'sizes': sorted(args.sizes),
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'login_requests': args.login_requests,
+            'scenarios': args.scenarios,
+            'storage': args.storage,
+            'auto_reload': args.auto_reload,
+            'throttle': args.throttle,
+        },
+        'proxy_commands': commands,
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ Результаты записаны в {output}")
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест сервиса управления 3proxy')
+    parser.add_argument('--sizes', type=int_list, default=DEFAULT_SIZES,
+                        help='размеры списка разрешенных IP через запятую')
+    parser.add_argument('--concurrency', type=int_list, default=DEFAULT_CONCURRENCY,
+                        help='количество одновременных клиентов через запятую')
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS,
+                        help='запросов на сценарий при каждом размере')
+    parser.add_argument('--login-requests', type=int, default=DEFAULT_LOGIN_REQUESTS,
+                        help='запросов на вход при каждом размере')
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=SCENARIOS,
+                        help=f'сценарии через запятую: {",".join(SCENARIOS)}')
+    parser.add_argument('--storage', choices=['sqlite', 'text'], default='sqlite',
+                        help='хранилище списка (STORAGE_BACKEND)')
+    parser.add_argument('--auto-reload', action='store_true',
+                        help='перезагружать поддельный 3proxy после каждого изменения (PROXY_AUTO_RELOAD)')
+    parser.add_argument('--throttle', action='store_true',
+                        help='не снимать ограничение попыток входа')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='файл для результатов в JSON')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(sorted(unknown))}')
+    return args
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
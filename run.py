@@ -1,46 +1,167 @@
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-"""
-Скрипт запуска сервиса управления 3proxy
-"""
-
-import os
-import sys
-import asyncio
-from aiohttp import web
-from app import create_app
-
-async def main():
-    print("🚀 Запуск сервиса управления 3proxy...")
-    print("📱 Веб-интерфейс: http://localhost:5000")
-    print("🔐 Страница входа: http://localhost:5000/login")
-    print("🔑 Логин: admin, Пароль: admin123")
-    print("⏹️  Для остановки нажмите Ctrl+C")
-    print("-" * 50)
-    
-    app = create_app()
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 5000)
-    await site.start()
-    
-    print("✅ Сервер запущен на http://0.0.0.0:5000")
-    print("📋 Доступные маршруты:")
-    for route in app.router.routes():
-        print(f"   {route.method:6} {route.resource}")
-    
-    try:
-        # Держим сервер запущенным
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        print("\n👋 Сервис остановлен")
-        await runner.cleanup()
-        sys.exit(0)
-
-if __name__ == '__main__':
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("\n👋 Сервис остановлен")
-        sys.exit(0)
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Скрипт запуска сервиса управления 3proxy
+
+С WORKERS > 1 запускается несколько рабочих процессов на общем порту (SO_REUSEPORT).
+Процесс 0 - писатель: только он меняет файлы конфигурации. Остальные процессы
+передают ему изменения и получают уведомления через unix сокет (WORKER_SOCKET).
+
+С --agent запускается агент узла: он принимает список от менеджера и применяет
+его к локальному 3proxy (порт AGENT_PORT, токен NODE_AGENT_TOKEN).
+"""
+
+import os
+import sys
+import signal
+import asyncio
+import subprocess
+import tempfile
+import time
+from aiohttp import web
+
+HOST = '0.0.0.0'
+PORT = 5000
+# Количество рабочих процессов
+WORKERS = int(os.environ.get('WORKERS', '1'))
+# Сколько ждать, пока писатель откроет unix сокет, прежде чем запускать остальных
+WRITER_START_TIMEOUT = 30
+# Пауза перед перезапуском упавшего рабочего процесса
+WORKER_RESTART_DELAY = 1
+
+async def serve(reuse_port=False, announce=True):
+    """Запускает приложение в текущем процессе до SIGINT/SIGTERM"""
+    from app import create_app
+
+    if announce:
+        print("🚀 Запуск сервиса управления 3proxy...")
+        print(f"📱 Веб-интерфейс: http://localhost:{PORT}")
+        print(f"🔐 Страница входа: http://localhost:{PORT}/login")
+        print("🔑 Логин: admin, Пароль: admin123")
+        print("⏹️  Для остановки нажмите Ctrl+C")
+        print("-" * 50)
+
+    app = create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, HOST, PORT, reuse_port=reuse_port)
+    await site.start()
+
+    if announce:
+        print(f"✅ Сервер запущен на http://{HOST}:{PORT}")
+        print("📋 Доступные маршруты:")
+        for route in app.router.routes():
+            print(f"   {route.method:6} {route.resource}")
+
+    try:
+        await wait_for_stop()
+    finally:
+        await runner.cleanup()
+
+async def serve_agent():
+    """Запускает агент узла до SIGINT/SIGTERM"""
+    from app import (NodeAgent, LocalNode, create_agent_app, CONFIG_FILE, ACL_FILE, ACL_INCLUDE_PATH,
+                     PROXY_CONFIG_PATH, PROXY_RELOAD_MODE, PROXY_AUTO_RELOAD, NODE_AGENT_TOKEN, AGENT_PORT)
+
+    if not NODE_AGENT_TOKEN:
+        print("❌ Для агента нужен токен в переменной NODE_AGENT_TOKEN")
+        return
+    node = LocalNode('agent', CONFIG_FILE, ACL_FILE, ACL_INCLUDE_PATH,
+                     reload=PROXY_RELOAD_MODE if PROXY_AUTO_RELOAD else None, config_path=PROXY_CONFIG_PATH)
+    agent = NodeAgent(node)
+    runner = web.AppRunner(create_agent_app(agent))
+    await runner.setup()
+    await web.TCPSite(runner, HOST, AGENT_PORT).start()
+    print(f"✅ Агент узла запущен на порту {AGENT_PORT}, версия списка: {agent.version}")
+    try:
+        await wait_for_stop()
+    finally:
+        await runner.cleanup()
+
+async def wait_for_stop():
+    """Ждет SIGINT/SIGTERM; на Windows Ctrl+C прерывает ожидание как KeyboardInterrupt"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Обработчики сигналов в цикле событий есть только на Unix
+            pass
+    await stop.wait()
+
+def spawn_worker(index, socket_path):
+    """Запускает рабочий процесс; процесс 0 - писатель"""
+    env = dict(os.environ,
+               WORKER_INDEX=str(index),
+               WORKER_ROLE='writer' if index == 0 else 'follower',
+               WORKER_SOCKET=socket_path)
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'], env=env)
+
+def wait_for_socket(path, process, timeout):
+    """Ждет, пока писатель начнет принимать соединения на unix сокете"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        if os.path.exists(path):
+            return True
+        time.sleep(0.1)
+    return False
+
+def supervise(workers):
+    """Запускает рабочие процессы и перезапускает упавшие"""
+    socket_path = os.environ.get('WORKER_SOCKET') or os.path.join(
+        tempfile.gettempdir(), f'3proxy-manager-{os.getpid()}.sock')
+    print(f"🚀 Запуск сервиса управления 3proxy: {workers} рабочих процессов на порту {PORT}")
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Старый сокет от прошлого запуска мешает дождаться нового писателя
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    processes = {0: spawn_worker(0, socket_path)}
+    if not wait_for_socket(socket_path, processes[0], WRITER_START_TIMEOUT):
+        print("❌ Процесс-писатель не запустился")
+    for index in range(1, workers):
+        processes[index] = spawn_worker(index, socket_path)
+    print(f"✅ Сервер запущен на http://{HOST}:{PORT}")
+
+    while not stopping:
+        for index, process in processes.items():
+            if process.poll() is not None and not stopping:
+                print(f"⚠️  Рабочий процесс {index} завершился с кодом {process.returncode}, перезапуск")
+                time.sleep(WORKER_RESTART_DELAY)
+                processes[index] = spawn_worker(index, socket_path)
+        time.sleep(0.5)
+
+    for process in processes.values():
+        if process.poll() is None:
+            process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    print("\n👋 Сервис остановлен")
+
+def run(main):
+    """Запускает корутину до остановки, в том числе по Ctrl+C"""
+    try:
+        asyncio.run(main)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    if '--worker' in sys.argv:
+        run(serve(reuse_port=True, announce=False))
+    elif '--agent' in sys.argv:
+        run(serve_agent())
+    elif WORKERS > 1:
+        supervise(WORKERS)
+    else:
+        run(serve())
+        print("\n👋 Сервис остановлен")
@@ -0,0 +1,50 @@
+"""Общие фикстуры тестов.
+
+app при импорте создает менеджер и читает переменные окружения, а пути в нем относительные -
+поэтому импортируем его из временного каталога и без sudo.
+"""
+import os
+import stat
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+IMPORT_DIR = tempfile.mkdtemp(prefix='3proxy-manager-tests-')
+for name in ('config', 'logs'):
+    os.makedirs(os.path.join(IMPORT_DIR, name), exist_ok=True)
+os.chdir(IMPORT_DIR)
+os.environ['PROXY_SUDO'] = ''
+os.environ.pop('NODES_FILE', None)
+os.environ.pop('IDLE_PRUNE_DAYS', None)
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Отдельный рабочий каталог с config и logs для каждого теста"""
+    for name in ('config', 'logs'):
+        (tmp_path / name).mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def fake_sudo(tmp_path):
+    """Поддельный sudo: записывает команду в журнал и ничего не запускает.
+
+    Возвращает (путь к sudo, функция чтения журнала команд).
+    """
+    log = tmp_path / 'commands.log'
+    path = tmp_path / 'sudo'
+    path.write_text(f'#!/bin/sh\necho "$@" >> "{log}"\nsleep 0.2\nexit 0\n')
+    path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    def commands():
+        return log.read_text().splitlines() if log.exists() else []
+
+    return str(path), commands
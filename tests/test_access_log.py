@@ -0,0 +1,30 @@
+import calendar
+
+import app
+
+
+def test_default_logformat_time_is_parsed_as_gmt():
+    line = '251017121314.123 3128 00000 - 192.168.1.10:51234 93.184.216.34:443 1024 2048 0 CONNECT example.com:443'
+
+    host, timestamp = app.parse_access_log_line(line)
+
+    assert host == '192.168.1.10'
+    assert timestamp == calendar.timegm((2025, 10, 17, 12, 13, 14)) + 0.123
+
+
+def test_lines_without_time_do_not_move_last_seen(workdir):
+    tailer = app.AccessLogTailer(path=str(workdir / 'logs' / '3proxy.log'),
+                                 state_file=str(workdir / 'config' / 'state.json'))
+    dated = b'1700000000.000 3128 00000 - 10.0.0.1:5000 1.1.1.1:80 0 0 0 GET http://a/\n'
+    undated = (b'garbage 3128 00000 - 10.0.0.1:5000 1.1.1.1:80 0 0 0 GET http://a/\n'
+               b'garbage 3128 00000 - 10.0.0.2:5000 1.1.1.1:80 0 0 0 GET http://a/\n')
+    batch = {}
+    tailer._parse(dated, batch)
+    tailer.merge(batch)
+    batch = {}
+    tailer._parse(undated, batch)
+    tailer.merge(batch)
+
+    # Запрос учтен, но время активности и охват журнала остались по датированной строке
+    assert tailer.clients == {'10.0.0.1': [1700000000.0, 2]}
+    assert (tailer.since, tailer.last_line) == (1700000000.0, 1700000000.0)
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('10.0.0.0/24', '10.0.0.0/24'),
+    (' 10.0.0.7/32 ', '10.0.0.7'),
+    ('2001:db8::/32', '2001:db8::/32'),
+    ('10.0.0.5/24', None),
+    ('2001:db8::1/32', None),
+])
+def test_networks_with_host_bits_are_invalid(value, expected):
+    assert app._try_normalize_ip_entry(value) == expected
+
+
+def test_typo_in_network_is_not_widened(workdir):
+    async def main():
+        manager = app.ProxyManager()
+        try:
+            await manager.start()
+            results = await manager.add_allowed_ips(['10.0.0.5/24', '10.0.1.0/24'])
+            return results, await manager.get_allowed_ips()
+        finally:
+            await manager.close()
+
+    results, entries = asyncio.run(main())
+
+    assert results[0] == {'ip': '10.0.0.5/24', 'status': 'invalid', 'network': '10.0.0.0/24'}
+    assert results[1]['status'] == 'added'
+    assert entries == ['10.0.1.0/24']
+    assert '10.0.0.0/24' in app._add_ip_response(results[0])['message']
@@ -0,0 +1,46 @@
+import asyncio
+
+import app
+
+
+def subscribe_and_collect(since, epoch_of):
+    """Публикует два изменения, подписывается с since и эпохой epoch_of(hub), возвращает полученное"""
+    async def main():
+        async def snapshot():
+            return hub.version, ['1.1.1.1', '2.2.2.2']
+
+        hub = app.AllowlistHub(snapshot)
+        hub.publish(['1.1.1.1'], [])
+        hub.publish(['2.2.2.2'], [])
+        received = []
+
+        async def send(event):
+            received.append(event)
+
+        subscription = hub.subscribe(send, since=since, epoch=epoch_of(hub))
+        await asyncio.sleep(0.01)
+        hub.unsubscribe(subscription)
+        return hub.epoch, received
+
+    return asyncio.run(main())
+
+
+def test_resume_within_epoch_sends_missed_changes():
+    epoch, received = subscribe_and_collect(1, lambda hub: hub.epoch)
+
+    assert [(event['type'], event['epoch'], event['version'], event['added']) for event in received] == [
+        ('allowlist_delta', epoch, 2, ['2.2.2.2'])]
+
+
+def test_resume_from_other_epoch_sends_snapshot():
+    # Версия совпадает с текущей, но она из прошлого запуска - изменений нет не потому, что их не было
+    epoch, received = subscribe_and_collect(2, lambda hub: 'previous')
+
+    assert received == [{'type': 'allowlist_snapshot', 'epoch': epoch, 'version': 2,
+                         'ips': ['1.1.1.1', '2.2.2.2']}]
+
+
+def test_resume_without_epoch_sends_snapshot():
+    epoch, received = subscribe_and_collect(1, lambda hub: None)
+
+    assert [event['type'] for event in received] == ['allowlist_snapshot']
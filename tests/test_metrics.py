@@ -0,0 +1,24 @@
+import app
+
+
+def test_samples_keep_full_precision():
+    counter = app.CounterMetric('test_precision_total', 'Проверка точности', ('route',))
+    histogram = app.HistogramMetric('test_precision_seconds', 'Проверка точности', buckets=(1,))
+    try:
+        counter.inc('/', amount=1234567)
+        histogram.observe(1234.56789)
+        lines = (counter.render() + '\n' + histogram.render()).splitlines()
+    finally:
+        app.METRICS.remove(counter)
+        app.METRICS.remove(histogram)
+
+    assert 'test_precision_total{route="/"} 1234567' in lines
+    assert 'test_precision_seconds_sum 1234.56789' in lines
+    assert 'test_precision_seconds_bucket{le="+Inf"} 1' in lines
+
+
+def test_special_values_use_prometheus_spelling():
+    assert app.format_metric_value(float('inf')) == '+Inf'
+    assert app.format_metric_value(float('-inf')) == '-Inf'
+    assert app.format_metric_value(float('nan')) == 'NaN'
+    assert app.format_metric_value(0.1) == '0.1'
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import app
+
+TOKEN = 'секрет'
+
+
+class RecordingAgent(app.NodeAgent):
+    """Агент, запоминающий вид каждого обновления и принял ли он его"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.updates = []
+
+    async def apply(self, data):
+        result = await super().apply(data)
+        self.updates.append(('full' if 'entries' in data else 'diff', result is not None))
+        return result
+
+
+async def wait_synced(fleet, timeout=5):
+    """Ждет, пока все узлы применят текущую версию списка"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(node['status'] == 'ok' and node['behind'] == 0 for node in fleet.status()):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f'Узлы не догнали список: {fleet.status()}')
+
+
+def acl_entries(directory):
+    lines = (directory / '3proxy_acl.cfg').read_text().splitlines()
+    return [line.split()[-1] for line in lines if line.startswith('allow')]
+
+
+class Fleet:
+    """Менеджер, два локальных узла и агент в отдельных временных каталогах"""
+
+    def __init__(self, workdir):
+        self.dirs = {name: workdir / name for name in ('edge-1', 'edge-2', 'agent')}
+        for directory in self.dirs.values():
+            directory.mkdir()
+
+    async def __aenter__(self):
+        agent_node = app.LocalNode('agent', str(self.dirs['agent'] / '3proxy.cfg'))
+        self.agent = RecordingAgent(agent_node, state_file=str(self.dirs['agent'] / 'state.json'))
+        self.server = TestServer(app.create_agent_app(self.agent, token=TOKEN))
+        await self.server.start_server()
+        self.manager = app.ProxyManager()
+        await self.manager.start()
+        nodes = [app.LocalNode(name, str(self.dirs[name] / '3proxy.cfg')) for name in ('edge-1', 'edge-2')]
+        nodes.append(app.AgentNode('agent', str(self.server.make_url('')), TOKEN))
+        self.fleet = app.NodeFleet(nodes, self.manager, timeout=2, retry_delay=0.01, resync_interval=60)
+        self.fleet.start()
+        await wait_synced(self.fleet)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.fleet.close()
+        await self.manager.close()
+        await self.server.close()
+
+
+def test_agent_receives_only_changes(workdir):
+    async def main():
+        async with Fleet(workdir) as env:
+            await env.manager.add_allowed_ips(['1.1.1.1', '2.2.2.0/24'])
+            await wait_synced(env.fleet)
+            await env.manager.remove_allowed_ips(['1.1.1.1'])
+            await wait_synced(env.fleet)
+            return env.agent.updates, env.agent.status(), env.manager.hub.version
+
+    updates, status, version = asyncio.run(main())
+
+    # Первая синхронизация - полный список, дальше агент догоняет только изменениями
+    assert updates[0] == ('full', True)
+    assert updates[1:] and all(update == ('diff', True) for update in updates[1:])
+    assert status['version'] == version and status['entries'] == 1
+    for name in ('edge-1', 'edge-2', 'agent'):
+        assert acl_entries(workdir / name) == ['2.2.2.0/24']
+        assert 'include' in (workdir / name / '3proxy.cfg').read_text()
+
+
+def test_agent_with_lost_state_gets_full_list_after_conflict(workdir):
+    async def main():
+        async with Fleet(workdir) as env:
+            await env.manager.add_allowed_ips(['1.1.1.1'])
+            await wait_synced(env.fleet)
+            # Агент перезапустился без файла состояния: менеджер об этом не знает и шлет изменения
+            env.agent.epoch = env.agent.version = None
+            env.agent.entries = {}
+            env.agent.updates.clear()
+            await env.manager.add_allowed_ips(['3.3.3.3'])
+            await wait_synced(env.fleet)
+            return env.agent.updates, env.agent.status(), env.fleet.status()
+
+    updates, status, nodes = asyncio.run(main())
+
+    assert updates == [('diff', False), ('full', True)]
+    assert status['entries'] == 2
+    assert all(node['status'] == 'ok' and node['error'] is None for node in nodes)
+    for name in ('edge-1', 'edge-2', 'agent'):
+        assert acl_entries(workdir / name) == ['1.1.1.1', '3.3.3.3']
+
+
+def test_agent_without_token_rejects_everyone(workdir):
+    agent = app.NodeAgent(app.LocalNode('agent', str(workdir / '3proxy.cfg')), state_file=str(workdir / 'state.json'))
+
+    async def main():
+        client = TestClient(TestServer(app.create_agent_app(agent, token=None)))
+        await client.start_server()
+        try:
+            statuses = []
+            for headers in ({}, {'Authorization': 'Bearer None'}, {'Authorization': 'Bearer '}):
+                async with client.get('/status', headers=headers) as response:
+                    statuses.append(response.status)
+                async with client.post('/apply', json={'epoch': 'x', 'version': 1, 'entries': ['1.1.1.1']},
+                                       headers=headers) as response:
+                    statuses.append(response.status)
+            return statuses
+        finally:
+            await client.close()
+
+    assert asyncio.run(main()) == [401] * 6
+    assert agent.version is None
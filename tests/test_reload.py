@@ -0,0 +1,38 @@
+import asyncio
+
+import app
+
+
+def test_requests_within_window_share_one_reload(fake_sudo):
+    sudo, commands = fake_sudo
+    strategy = app.RestartReload(binary='/opt/3proxy/bin/3proxy', sudo=sudo)
+    reloader = app.ProxyReloader(strategy, 'config/3proxy_ip.cfg', window=0.05)
+
+    async def main():
+        return await asyncio.gather(*(reloader.request() for _ in range(5)))
+
+    results = asyncio.run(main())
+
+    assert commands() == ['pkill -x 3proxy', '/opt/3proxy/bin/3proxy config/3proxy_ip.cfg']
+    assert all(result['success'] for result in results)
+    assert [result['coalesced'] for result in results] == [5] * 5
+
+
+def test_request_during_reload_gets_next_reload(fake_sudo):
+    sudo, commands = fake_sudo
+    strategy = app.SignalReload(binary='/opt/3proxy/bin/3proxy', sudo=sudo)
+    reloader = app.ProxyReloader(strategy, 'config/3proxy_ip.cfg', window=0.05)
+
+    async def main():
+        first = [asyncio.ensure_future(reloader.request()) for _ in range(3)]
+        # Окно первой перезагрузки закрылось, команда еще выполняется
+        await asyncio.sleep(0.1)
+        second = [asyncio.ensure_future(reloader.request()) for _ in range(2)]
+        return await asyncio.gather(*first), await asyncio.gather(*second)
+
+    first, second = asyncio.run(main())
+
+    assert commands() == ['pkill -USR1 -x 3proxy'] * 2
+    assert [result['coalesced'] for result in first] == [3] * 3
+    assert [result['coalesced'] for result in second] == [2] * 2
+
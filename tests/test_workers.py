@@ -0,0 +1,49 @@
+import asyncio
+
+from aiohttp import web
+
+import app
+
+
+async def wait_following(follower, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not follower._following:
+        assert loop.time() < deadline, 'Последователь не подключился к писателю'
+        await asyncio.sleep(0.01)
+
+
+def test_follower_reads_its_own_writes(workdir, monkeypatch):
+    socket_path = str(workdir / 'writer.sock')
+
+    async def main():
+        writer = app.ProxyManager()
+        monkeypatch.setattr(app, 'proxy_manager', writer)
+        await writer.start()
+        runner = web.AppRunner(app.create_worker_app())
+        await runner.setup()
+        await web.UnixSite(runner, socket_path).start()
+        follower = app.FollowerProxyManager(socket_path=socket_path)
+        try:
+            await follower.start()
+            await wait_following(follower)
+            missing = []
+            for i in range(20):
+                ip = f'10.1.0.{i}'
+                results = await follower.add_allowed_ips([ip], comment='тест')
+                assert results[0]['status'] == 'added'
+                if ip not in await follower.get_allowed_ips():
+                    missing.append(ip)
+            await follower.remove_allowed_ips(['10.1.0.0'])
+            after_remove = await follower.get_allowed_ips()
+            return missing, after_remove, (follower.hub.epoch, follower.hub.version), (writer.hub.epoch, writer.hub.version)
+        finally:
+            await follower.close()
+            await runner.cleanup()
+            await writer.close()
+
+    missing, after_remove, follower_version, writer_version = asyncio.run(main())
+
+    assert missing == []
+    assert '10.1.0.0' not in after_remove and len(after_remove) == 19
+    assert follower_version == writer_version
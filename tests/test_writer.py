@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+class Recorder:
+    """prepare и commit для писателя, запоминающие свои вызовы"""
+
+    def __init__(self, fail_commit=False):
+        self.prepared = 0
+        self.committed = 0
+        self.fail_commit = fail_commit
+
+    async def prepare(self):
+        self.prepared += 1
+
+    async def commit(self):
+        self.committed += 1
+        if self.fail_commit:
+            raise OSError('диск заполнен')
+
+
+def test_concurrent_submits_are_committed_once():
+    recorder = Recorder()
+    writer = app.ConfigWriter(recorder.prepare, recorder.commit, window=0.01)
+    applied = []
+
+    def mutation(value):
+        def apply():
+            applied.append(value)
+            return value, True
+        return apply
+
+    def failing():
+        raise ValueError('неверная запись')
+
+    async def main():
+        results = await asyncio.gather(*(writer.submit(mutation(i)) for i in range(5)),
+                                       writer.submit(failing), return_exceptions=True)
+        await writer.close()
+        return results
+
+    results = asyncio.run(main())
+
+    assert results[:5] == [0, 1, 2, 3, 4]
+    assert isinstance(results[5], ValueError)
+    assert applied == [0, 1, 2, 3, 4]
+    assert (recorder.prepared, recorder.committed) == (1, 1)
+
+
+def test_unchanged_batch_is_not_committed():
+    recorder = Recorder()
+    writer = app.ConfigWriter(recorder.prepare, recorder.commit, window=0)
+
+    async def main():
+        result = await writer.submit(lambda: ('exists', False))
+        await writer.close()
+        return result
+
+    assert asyncio.run(main()) == 'exists'
+    assert recorder.committed == 0
+
+
+def test_failed_commit_fails_whole_batch():
+    recorder = Recorder(fail_commit=True)
+    writer = app.ConfigWriter(recorder.prepare, recorder.commit, window=0.01)
+
+    async def main():
+        results = await asyncio.gather(*(writer.submit(lambda: ('added', True)) for _ in range(3)),
+                                       return_exceptions=True)
+        recorder.fail_commit = False
+        after = await writer.submit(lambda: ('added', True))
+        await writer.close()
+        return results, after
+
+    results, after = asyncio.run(main())
+
+    assert all(isinstance(result, OSError) for result in results)
+    assert after == 'added'
+    assert not writer.busy
+    assert recorder.committed == 2
+
+
+def test_manager_rolls_back_to_disk_after_failed_save(workdir, monkeypatch):
+    async def main():
+        manager = app.ProxyManager()
+        try:
+            await manager.start()
+            await manager.add_allowed_ips(['1.1.1.1'])
+            version = manager.hub.version
+
+            save = manager.storage.save
+
+            def broken_save(*args):
+                raise OSError('диск заполнен')
+
+            monkeypatch.setattr(manager.storage, 'save', broken_save)
+            results = await asyncio.gather(manager.add_allowed_ips(['2.2.2.2']),
+                                           manager.remove_allowed_ips(['1.1.1.1']),
+                                           return_exceptions=True)
+            assert all(isinstance(result, OSError) for result in results)
+            # Подписчики должны перечитать список: версия сменилась, история сброшена
+            assert manager.hub.version > version
+
+            monkeypatch.setattr(manager.storage, 'save', save)
+            assert await manager.get_allowed_ips() == ['1.1.1.1']
+            await manager.add_allowed_ips(['3.3.3.3'])
+            return await manager.get_allowed_ips()
+        finally:
+            await manager.close()
+
+    assert asyncio.run(main()) == ['1.1.1.1', '3.3.3.3']
+    acl = (workdir / 'config' / '3proxy_acl.cfg').read_text()
+    assert 'allow * 1.1.1.1' in acl and 'allow * 3.3.3.3' in acl
+    assert '2.2.2.2' not in acl
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'text'])
+def test_manager_batches_concurrent_adds_into_one_save(workdir, monkeypatch, backend):
+    async def main():
+        manager = app.ProxyManager(storage=app.STORAGE_BACKENDS[backend]())
+        try:
+            await manager.start()
+            saves = []
+            save = manager.storage.save
+
+            def counting_save(*args):
+                saves.append(args)
+                return save(*args)
+
+            monkeypatch.setattr(manager.storage, 'save', counting_save)
+            await asyncio.gather(*(manager.add_allowed_ip(f'10.0.0.{i}') for i in range(10)))
+            return saves, await manager.get_allowed_ips()
+        finally:
+            await manager.close()
+
+    saves, entries = asyncio.run(main())
+
+    assert len(saves) == 1
+    assert sorted(entries) == sorted(f'10.0.0.{i}' for i in range(10))